@@ -1,118 +1,447 @@
 from lightglue.light_glue.lightglue import LightGlue, SuperPoint, DISK, SIFT, ALIKED, DoGHardNet
-from lightglue.light_glue.lightglue.utils import load_image, rbd
+from lightglue.light_glue.lightglue.utils import read_image, numpy_image_to_torch, rbd
+from lightglue.light_glue.lightglue.lightglue import (normalize_keypoints, pad_to_length,
+                                                      sigmoid_log_double_softmax, filter_matches)
 
 import numpy as np
 import cv2
 import torch
 import os
 import argparse
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
-def align_images(img1: str, img2: str):
-    # -----------------------------
-    # Helper function
-    # -----------------------------
-    def torch_to_cv_u8(img_t: torch.Tensor) -> np.ndarray:
-        # img_t: (3,H,W), float [0,1]
-        img = (img_t.permute(1, 2, 0).detach().cpu().numpy() * 255.0).clip(0, 255).astype(np.uint8)
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-        return img
+def pyramid_level(img: np.ndarray, long_side: int):
+    """
+    RGB uint8 img resized so its long side is long_side, and the (sx, sy) scale from
+    full resolution to that level. Features are extracted on this level only.
+    """
+    h, w = img.shape[:2]
+    if long_side is None or max(h, w) == long_side:
+        return img, (1.0, 1.0)
+    scale = long_side / float(max(h, w))
+    size = (int(round(w * scale)), int(round(h * scale)))
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    small = cv2.resize(img, size, interpolation=interpolation)
+    return small, (size[0] / float(w), size[1] / float(h))
 
-    # --- Detect device (GPU if available, else CPU) ---
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    if device.type == 'cpu':
-        print("⚠️  GPU not available, using CPU for image alignment (this will be slower)")
 
-    # --- extractor & matcher (DISK example) ---
-    extractor = DISK(max_num_keypoints=2048).eval().to(device)
-    matcher = LightGlue(features='disk').eval().to(device)
+def image_key(img: np.ndarray) -> str:
+    """Content hash of a uint8 image array, used to look up cached features."""
+    sha = hashlib.sha1(np.ascontiguousarray(img).data)
+    sha.update(str(img.shape).encode('utf-8'))
+    return sha.hexdigest()
 
-    # --- load images ---
-    image0 = load_image(img1).to(device)
-    image1 = load_image(img2).to(device)
 
-    # --- extract features ---
-    feats0 = extractor.extract(image0)
-    feats1 = extractor.extract(image1)
+class AlignmentCache:
+    """
+    LRU of DISK features per image hash and of (homography, inliers) per image pair,
+    optionally persisted as .npz files in cache_dir so they survive restarts.
+    """
 
-    # --- match ---
-    matches01 = matcher({'image0': feats0, 'image1': feats1})
+    def __init__(self, max_entries=256, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-    # remove batch dimension
-    feats0, feats1, matches01 = [rbd(x) for x in [feats0, feats1, matches01]]
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
 
-    score_thresh = 0.85
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        value = self._load(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._remember(key, value)
+        return value
 
-    scores  = matches01['scores']     # (K,)
-    matches = matches01['matches']    # (K, 2)
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + '.npz')
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, **value)
+            os.replace(path + '.tmp', path)
 
-    mask = scores > score_thresh
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
 
-    matches = matches[mask]
-    scores  = scores[mask]
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with np.load(os.path.join(self.cache_dir, key + '.npz')) as data:
+                return {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
 
-    # update matches01 so viz2d uses filtered matches
-    matches01['matches'] = matches
-    matches01['scores']  = scores
 
-    # matched keypoints
-    points0 = feats0['keypoints'][matches[:, 0]]
-    points1 = feats1['keypoints'][matches[:, 1]]
+class Aligner:
+    """
+    DISK extractor and LightGlue matcher kept on device and reused across image pairs.
+    Use get_aligner() to share one instance per device in the process.
 
-    print(f"Kept {len(matches)} matches with score > {score_thresh}")
+    Features are cached per image content and homographies per image pair, so
+    re-running a pair (e.g. with other model parameters) skips registration.
+    """
 
-    # -----------------------------
-    # 1) Prepare matched points
-    # -----------------------------
-    pts0 = points0.detach().cpu().numpy().astype(np.float32)  # in image0 coords
-    pts1 = points1.detach().cpu().numpy().astype(np.float32)  # in image1 coords
+    def __init__(self, device=None, max_num_keypoints=2048, score_thresh=0.85, cache=None,
+                 warp_tile_size=1024, warp_threads=1):
+        # --- Detect device (GPU if available, else CPU) ---
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = torch.device(device)
+        if self.device.type == 'cpu':
+            print("⚠️  GPU not available, using CPU for image alignment (this will be slower)")
 
-    if len(pts0) < 10:
-        print(f"Not enough matches for homography: {len(pts0)}. Skipping alignment.")
-        # Return original images
-        img0_cv = torch_to_cv_u8(image0)
-        img1_cv = torch_to_cv_u8(image1)
-        return img0_cv, img1_cv
+        self.score_thresh = score_thresh
+        self.warp_tile_size = warp_tile_size
+        self.warp_threads = warp_threads
+        self.cache = cache if cache is not None else AlignmentCache()
 
-    # -----------------------------
-    # 2) Estimate homography H: image1 -> image0
-    # -----------------------------
-    H, inlier_mask = cv2.findHomography(pts1, pts0, cv2.RANSAC, 5.0)
+        # --- extractor & matcher (DISK example) ---
+        self.extractor = DISK(max_num_keypoints=max_num_keypoints).eval().to(self.device)
+        self.matcher = LightGlue(features='disk').eval().to(self.device)
 
-    if H is None:
-        print("Homography estimation failed. Using original images.")
-        img0_cv = torch_to_cv_u8(image0)
-        img1_cv = torch_to_cv_u8(image1)
-        return img0_cv, img1_cv
+    def align(self, img1: str, img2: str):
+        """Align the image at path img2 onto img1; returns both images as BGR uint8 arrays."""
+        img0_aligned, img1_aligned = self.align_arrays(np.ascontiguousarray(read_image(img1)),
+                                                       np.ascontiguousarray(read_image(img2)))
+        return (cv2.cvtColor(img0_aligned, cv2.COLOR_RGB2BGR),
+                cv2.cvtColor(img1_aligned, cv2.COLOR_RGB2BGR))
 
-    inliers = int(inlier_mask.sum()) if inlier_mask is not None else 0
-    print("Homography inliers:", inliers, "/", len(pts0))
+    def align_arrays(self, img0: np.ndarray, img1: np.ndarray):
+        """Align RGB uint8 array img1 onto img0; returns both images as RGB uint8 arrays."""
+        H, inliers = self.homography(img0, img1)
+        if H is None:
+            # Return original images
+            return img0, img1
+        return warp_pair(img0, img1, H, self.warp_tile_size, self.warp_threads)
 
-    # -----------------------------
-    # 3) Convert torch images to OpenCV uint8
-    # -----------------------------
-    img0_cv = torch_to_cv_u8(image0)
-    img1_cv = torch_to_cv_u8(image1)
+    def align_many(self, reference: np.ndarray, targets, batch_size=4):
+        """
+        Align every RGB uint8 target onto one reference image. The reference features
+        are extracted once and the targets batch_size at a time, so N targets cost
+        N + 1 extractions instead of 2N. Returns [(reference_aligned, target_aligned)].
+        """
+        return self.align_pairs([reference] * len(targets), targets, batch_size)
 
+    def align_pairs(self, images0, images1, batch_size=4):
+        """
+        align_arrays for many pairs. Every distinct image is extracted once (batch_size
+        same-size images per DISK pass) and pairs are matched batch_size at a time.
+        """
+        keys0 = [image_key(img) for img in images0]
+        keys1 = [image_key(img) for img in images1]
+        pair_keys = [self._pair_key(key0, key1) for key0, key1 in zip(keys0, keys1)]
+
+        pairs = [self.cache.get(pair_key) for pair_key in pair_keys]
+        todo = [i for i, pair in enumerate(pairs) if pair is None]
+        if todo:
+            feats = self.features_many([images0[i] for i in todo] + [images1[i] for i in todo],
+                                       [keys0[i] for i in todo] + [keys1[i] for i in todo], batch_size)
+            feats0, feats1 = feats[:len(todo)], feats[len(todo):]
+            for start in range(0, len(todo), batch_size):
+                chunk = slice(start, start + batch_size)
+                for i, (H, inliers) in zip(todo[chunk], self._estimate_many(feats0[chunk], feats1[chunk])):
+                    pairs[i] = self._store_pair(pair_keys[i], H, inliers)
+
+        aligned = []
+        for img0, img1, pair in zip(images0, images1, pairs):
+            H = pair['H'] if pair['H'].size else None
+            aligned.append((img0, img1) if H is None else
+                           warp_pair(img0, img1, H, self.warp_tile_size, self.warp_threads))
+        return aligned
+
+    def _pair_key(self, key0, key1):
+        return 'pair_%s_%s_%g' % (key0, key1, self.score_thresh)
+
+    def _store_pair(self, pair_key, H, inliers):
+        pair = {'H': np.zeros((0, 3)) if H is None else H, 'inliers': np.asarray(inliers)}
+        self.cache.put(pair_key, pair)
+        return pair
+
+    def homography(self, img0: np.ndarray, img1: np.ndarray):
+        """
+        (H, inliers) mapping img1 onto img0, H None when the pair cannot be registered.
+        Cached per pair; the DISK features of each image are cached on their own.
+        """
+        key0, key1 = image_key(img0), image_key(img1)
+        pair_key = self._pair_key(key0, key1)
+        pair = self.cache.get(pair_key)
+        if pair is None:
+            [(H, inliers)] = self._estimate_many([self.features(img0, key0)], [self.features(img1, key1)])
+            pair = self._store_pair(pair_key, H, inliers)
+        H = pair['H'] if pair['H'].size else None
+        return H, int(pair['inliers'])
+
+    def features(self, img: np.ndarray, key: str = None):
+        """DISK features of an RGB uint8 image as numpy arrays with a batch dimension of 1."""
+        key = 'feats_%s' % (key or image_key(img))
+        feats = self.cache.get(key)
+        if feats is None:
+            feats = self._extract_batch([img])[0]
+            self.cache.put(key, feats)
+        return feats
+
+    def features_many(self, images, keys=None, batch_size=4):
+        """features() for many images; cache misses of the same size are extracted batch_size at a time."""
+        if keys is None:
+            keys = [image_key(img) for img in images]
+        found = {}
+        by_shape = OrderedDict()  # image shape -> indices of distinct images to extract
+        for i, key in enumerate(keys):
+            if key in found:
+                continue
+            found[key] = self.cache.get('feats_%s' % key)
+            if found[key] is None:
+                by_shape.setdefault(images[i].shape, []).append(i)
+        for indices in by_shape.values():
+            for start in range(0, len(indices), batch_size):
+                chunk = indices[start:start + batch_size]
+                for i, f in zip(chunk, self._extract_batch([images[i] for i in chunk])):
+                    found[keys[i]] = f
+                    self.cache.put('feats_%s' % keys[i], f)
+        return [found[key] for key in keys]
+
+    @torch.no_grad()
+    def _extract_batch(self, images):
+        """
+        DISK on a stack of same-size RGB uint8 images. Only the pyramid level the
+        extractor works on (long side preprocess_conf['resize']) is built, in uint8 on
+        the CPU, and the keypoints are lifted back to full resolution, so neither the
+        full-resolution image nor a float copy of it ever reaches the device.
+        Extractor.extract only takes one image and DISK.forward stacks keypoint sets,
+        which may differ in length, so the kornia model is called directly.
+        """
+        extractor = self.extractor
+        conf = extractor.conf
+        levels = [pyramid_level(img, extractor.preprocess_conf.get('resize')) for img in images]
+        (sx, sy) = levels[0][1]
+        imgs = torch.stack([numpy_image_to_torch(level) for level, _ in levels]).to(self.device)
+        scales = torch.tensor([sx, sy], dtype=imgs.dtype, device=imgs.device)
+        features = extractor.model(imgs, n=conf.max_num_keypoints, window_size=conf.nms_window_size,
+                                   score_threshold=conf.detection_threshold,
+                                   pad_if_not_divisible=conf.pad_if_not_divisible)
+        h, w = images[0].shape[:2]
+        image_size = np.array([[w, h]], dtype=np.float32)
+        return [{
+            'keypoints': ((f.keypoints + 0.5) / scales[None] - 0.5)[None].cpu().numpy(),
+            'keypoint_scores': f.detection_scores[None].cpu().numpy(),
+            'descriptors': f.descriptors[None].cpu().numpy(),
+            'image_size': image_size,
+        } for f in features]
+
+    def _estimate_many(self, feats0_list, feats1_list):
+        """
+        (H, inliers) of several pairs, matched together in one padded LightGlue pass. A lone
+        pair goes through match_batch too, so its homography does not depend on the batch.
+        """
+        device = self.device
+        feats0_list = [{k: torch.from_numpy(v).to(device) for k, v in f.items()} for f in feats0_list]
+        feats1_list = [{k: torch.from_numpy(v).to(device) for k, v in f.items()} for f in feats1_list]
+        results = []
+        for feats0, feats1, matches01 in zip(feats0_list, feats1_list,
+                                             match_batch(self.matcher, feats0_list, feats1_list)):
+            results.append(self._homography_from_matches(rbd(feats0), rbd(feats1), matches01))
+        return results
+
+    def _homography_from_matches(self, feats0, feats1, matches01):
+        score_thresh = self.score_thresh
+
+        scores  = matches01['scores']     # (K,)
+        matches = matches01['matches']    # (K, 2)
+
+        mask = scores > score_thresh
+
+        matches = matches[mask]
+        scores  = scores[mask]
+
+        # matched keypoints
+        points0 = feats0['keypoints'][matches[:, 0]]
+        points1 = feats1['keypoints'][matches[:, 1]]
+
+        print(f"Kept {len(matches)} matches with score > {score_thresh}")
+
+        # -----------------------------
+        # 1) Prepare matched points
+        # -----------------------------
+        pts0 = points0.detach().cpu().numpy().astype(np.float32)  # in image0 coords
+        pts1 = points1.detach().cpu().numpy().astype(np.float32)  # in image1 coords
+
+        if len(pts0) < 10:
+            print(f"Not enough matches for homography: {len(pts0)}. Skipping alignment.")
+            return None, 0
+
+        # -----------------------------
+        # 2) Estimate homography H: image1 -> image0
+        # -----------------------------
+        H, inlier_mask = cv2.findHomography(pts1, pts0, cv2.RANSAC, 5.0)
+
+        if H is None:
+            print("Homography estimation failed. Using original images.")
+            return None, 0
+
+        inliers = int(inlier_mask.sum()) if inlier_mask is not None else 0
+        print("Homography inliers:", inliers, "/", len(pts0))
+        return H, inliers
+
+
+def _stack_padded(feats_list):
+    """Normalized keypoints, descriptors and validity masks of several images padded to one length."""
+    length = max(f['keypoints'].shape[1] for f in feats_list)
+    kpts, descs, masks = [], [], []
+    for f in feats_list:
+        k, _ = pad_to_length(normalize_keypoints(f['keypoints'], f['image_size']), length)
+        d, mask = pad_to_length(f['descriptors'].contiguous(), length)
+        kpts.append(k)
+        descs.append(d)
+        masks.append(mask)
+    return torch.cat(kpts), torch.cat(descs), torch.cat(masks)
+
+
+@torch.no_grad()
+def match_batch(matcher: LightGlue, feats0_list, feats1_list):
+    """
+    Match many pairs in one LightGlue pass. Keypoint sets are padded with pad_to_length
+    and the padding is masked in TransformerLayer.masked_forward and in the assignment,
+    so a pair gets the same matches in any batch, a batch of one included. All layers run
+    on all points: unlike LightGlue's own forward there is no early stopping or point
+    pruning (depth_confidence / width_confidence), which do not work on padded batches.
+    Returns one {'matches', 'scores'} per pair.
+    """
+    kpts0, desc0, mask0 = _stack_padded(feats0_list)
+    kpts1, desc1, mask1 = _stack_padded(feats1_list)
+
+    desc0 = matcher.input_proj(desc0)
+    desc1 = matcher.input_proj(desc1)
+    encoding0 = matcher.posenc(kpts0)
+    encoding1 = matcher.posenc(kpts1)
+    for layer in matcher.transformers:
+        # (B, 1, M, 1) masks broadcast over the attention heads
+        desc0, desc1 = layer(desc0, desc1, encoding0, encoding1, mask0=mask0[:, None], mask1=mask1[:, None])
+
+    # MatchAssignment of the last layer with padded rows / columns masked out
+    assignment = matcher.log_assignment[-1]
+    mdesc0, mdesc1 = assignment.final_proj(desc0), assignment.final_proj(desc1)
+    d = mdesc0.shape[-1]
+    sim = torch.einsum("bmd,bnd->bmn", mdesc0 / d**0.25, mdesc1 / d**0.25)
+    valid = mask0 & mask1.transpose(-1, -2)
+    sim = sim.masked_fill(~valid, torch.finfo(sim.dtype).min)
+    scores = sigmoid_log_double_softmax(sim, assignment.matchability(desc0), assignment.matchability(desc1))
+    scores[:, :-1, :-1] = scores[:, :-1, :-1].masked_fill(~valid, float('-inf'))
+    m0, _, mscores0, _ = filter_matches(scores, matcher.conf.filter_threshold)
+
+    results = []
+    for i, feats0 in enumerate(feats0_list):
+        m = feats0['keypoints'].shape[1]
+        matched = m0[i, :m] > -1
+        idx0 = torch.where(matched)[0]
+        results.append({'matches': torch.stack([idx0, m0[i, :m][idx0]], -1),
+                        'scores': mscores0[i, :m][idx0]})
+    return results
+
+
+def warp_pair(img0_cv: np.ndarray, img1_cv: np.ndarray, H: np.ndarray, tile_size=1024, threads=1):
+    """
+    Warp RGB uint8 img1 onto img0 with H and black out img0 where img1 has no data.
+
+    The output is produced tile_size x tile_size tiles at a time: each tile is warped
+    with H shifted to the tile origin and its validity mask (warped pixels that are not
+    black) is computed on the tile only, so temporaries scale with the tile, not the
+    scene. Tiles outside the warped footprint of img1 are left black without warping.
+    threads > 1 warps tiles in parallel (cv2 releases the GIL).
+    """
     h0, w0 = img0_cv.shape[:2]
     h1, w1 = img1_cv.shape[:2]
+    img0_aligned = np.zeros_like(img0_cv)
+    img1_aligned = np.zeros((h0, w0) + img1_cv.shape[2:], dtype=img1_cv.dtype)
 
-    # -----------------------------
-    # 4) Warp image1 to image0's coordinate system
-    # -----------------------------
-    img1_warp = cv2.warpPerspective(img1_cv, H, (w0, h0), flags=cv2.INTER_LINEAR, borderValue=(0, 0, 0))
+    # Bounding box of img1's corners in img0, when none of them goes to infinity
+    corners = np.array([[0, 0, 1], [w1, 0, 1], [w1, h1, 1], [0, h1, 1]], dtype=np.float64) @ H.T
+    footprint = None
+    if np.all(corners[:, 2] > 1e-9):
+        corners = corners[:, :2] / corners[:, 2:]
+        footprint = (corners[:, 0].min() - 1, corners[:, 1].min() - 1,
+                     corners[:, 0].max() + 1, corners[:, 1].max() + 1)
 
-    # -----------------------------
-    # 5) Create validity mask for warped image1 (where pixels are not black)
-    # -----------------------------
-    mask = (img1_warp.sum(axis=2) > 0).astype(np.uint8) * 255
+    def warp_tile(box):
+        left, upper, right, lower = box
+        if footprint is not None and (right <= footprint[0] or left >= footprint[2]
+                                      or lower <= footprint[1] or upper >= footprint[3]):
+            return
+        # H followed by a shift of the tile origin to (0, 0)
+        shift = np.array([[1, 0, -left], [0, 1, -upper], [0, 0, 1]], dtype=np.float64)
+        tile = cv2.warpPerspective(img1_cv, shift @ H, (right - left, lower - upper),
+                                   flags=cv2.INTER_LINEAR, borderValue=(0, 0, 0))
+        img1_aligned[upper:lower, left:right] = tile
+        valid = tile.any(axis=2) if tile.ndim == 3 else tile > 0
+        np.copyto(img0_aligned[upper:lower, left:right], img0_cv[upper:lower, left:right],
+                  where=valid[..., None] if img0_cv.ndim == 3 else valid)
 
-    # -----------------------------
-    # 6) Apply mask to img0 to remove areas not present in warped img1
-    # -----------------------------
-    img0_aligned = cv2.bitwise_and(img0_cv, img0_cv, mask=mask)
-    img1_aligned = img1_warp  # already has black areas
+    boxes = [(left, upper, min(left + tile_size, w0), min(upper + tile_size, h0))
+             for upper in range(0, h0, tile_size) for left in range(0, w0, tile_size)]
+    if threads > 1 and len(boxes) > 1:
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='warp') as pool:
+            list(pool.map(warp_tile, boxes))
+    else:
+        for box in boxes:
+            warp_tile(box)
 
     print("Aligned image sizes:", img0_aligned.shape, img1_aligned.shape)
 
-    return img0_aligned, img1_aligned
\ No newline at end of file
+    return img0_aligned, img1_aligned
+
+
+_aligners = {}
+_aligners_lock = threading.Lock()
+
+
+def get_aligner(device=None) -> Aligner:
+    """Return the process-wide Aligner for device, creating it on first use."""
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    key = str(torch.device(device))
+    with _aligners_lock:
+        aligner = _aligners.get(key)
+        if aligner is None:
+            aligner = Aligner(device, cache=AlignmentCache(
+                max_entries=int(os.environ.get('CD_ALIGN_CACHE_SIZE', 256)),
+                cache_dir=os.environ.get('CD_ALIGN_CACHE_DIR') or None),
+                warp_threads=int(os.environ.get('CD_WARP_THREADS', 1)))
+            _aligners[key] = aligner
+    return aligner
+
+
+def align_images(img1: str, img2: str, aligner: Aligner = None):
+    if aligner is None:
+        aligner = get_aligner()
+    return aligner.align(img1, img2)
+
+
+def align_to_reference(reference: np.ndarray, targets, aligner: Aligner = None, batch_size=4):
+    """Align RGB uint8 targets onto one reference; see Aligner.align_many."""
+    if aligner is None:
+        aligner = get_aligner()
+    return aligner.align_many(reference, targets, batch_size)
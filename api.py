@@ -1,4 +1,5 @@
 import os
+import asyncio
 import tempfile
 import base64
 import zipfile
@@ -6,15 +7,46 @@ import shutil
 import urllib.request
 from io import BytesIO
 from pathlib import Path
-from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, Depends
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List
+import numpy as np
 import torch
-from run import run_change_detection
+from PIL import Image
+from run import OUTPUTS, run_change_detection_arrays, build_args, load_model, parse_outputs, render_outputs
+from align import get_aligner
+from inference_queue import executor_from_env, gpu_gate_from_env, QueueFullError, InferenceExecutor
+from jobs import JobStore
+from micro_batching import batcher_from_env
+from result_cache import cache_from_env, checkpoint_hash, result_key
+from response_formats import RESPONSE_FORMATS, get_writer
+from encoders import IMAGE_CODECS, MASK_CODECS, Encoder
 
 app = FastAPI()
 
+# Blocking inference runs here, never on the event loop (see CD_INFERENCE_* env vars)
+inference_executor = executor_from_env()
+
+# /jobs run on their own pool with a longer queue; finished jobs are kept for CD_JOB_TTL seconds
+job_executor = InferenceExecutor(
+    concurrency=int(os.environ.get('CD_JOB_CONCURRENCY', 1)),
+    max_queue=int(os.environ.get('CD_JOB_QUEUE_SIZE', 32)),
+    retry_after=int(os.environ.get('CD_INFERENCE_RETRY_AFTER', 10)),
+)
+job_store = JobStore(ttl=int(os.environ.get('CD_JOB_TTL', 3600)))
+
+# Forward passes of /change-detection and /jobs together stay within CD_INFERENCE_CONCURRENCY
+# (with the micro-batcher they already run one at a time on its dispatcher thread)
+gpu_gate = gpu_gate_from_env()
+
+# Tiles of concurrent requests share forward passes (window set by CD_BATCH_WINDOW_MS)
+batcher = batcher_from_env()
+
+# Results of already seen image pairs, keyed by content (see CD_CACHE_* env vars)
+result_cache = cache_from_env()
+CHECKPOINT_PATH = os.path.join("checkpoints", "ChangeFormer_DSIFN", "best_ckpt.pt")
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -89,20 +121,112 @@ def download_and_setup_checkpoints():
         os.unlink(zip_path)
         shutil.rmtree(extract_dir, ignore_errors=True)
 
+def get_gpu_ids():
+    # Auto-detect GPU availability
+    return '0' if torch.cuda.is_available() else '-1'  # -1 means CPU
+
 @app.on_event("startup")
 async def startup_event():
-    """Download checkpoints on startup if they don't exist"""
+    """Download checkpoints on startup if they don't exist and load the model once"""
     download_and_setup_checkpoints()
+    load_model(build_args(project_name='ChangeFormer_DSIFN', checkpoint_name='best_ckpt.pt',
+                          gpu_ids=get_gpu_ids()))
+    get_aligner()  # warm up DISK + LightGlue so the first request does not pay for it
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    inference_executor.shutdown(wait=False)
+    job_executor.shutdown(wait=False)
+
+@app.get("/health")
+async def health():
+    """Liveness probe; answers even while inference is running"""
+    return {"status": "ok", "inference": inference_executor.stats(), "jobs": job_executor.stats(),
+            "batching": batcher.stats() if batcher is not None else None,
+            "cache": result_cache.stats() if result_cache is not None else None,
+            "alignment_cache": get_aligner().cache.stats()}
+
+def detection_params(
+    img_size: int = Form(1024, description="Image size for processing (base size for first call)"),
+    n: int = Form(2, description="Number of crops per side for spatial tiling (total crops = n x n). Each piece in subsequent calls will be processed at current_img_size = img_size / (2^(call-1))"),
+    calls_nb: int = Form(2, description="Number of model calls with decreasing img_size. Each call uses img_size / (2^(call-1)). For calls > 1, images are cropped into pieces where each piece size equals the current_img_size for that call."),
+    crop_image: bool = Form(True, description="Crop images for calls > 1. When True, images are cropped into pieces for processing in subsequent calls."),
+    batch_size: int = Form(4, description="Number of tiles with the same size (across images and calls) processed in one forward pass"),
+    precision: str = Form("fp32", description="Inference precision: fp32, bf16 or fp16 (fp16 on CUDA only, bf16 is used on CPU)"),
+    channels_last: bool = Form(False, description="Run the network with channels-last memory format"),
+    verify_precision: bool = Form(False, description="With bf16/fp16, also run fp32 and report the mask agreement per image"),
+    output_mode: str = Form("mask", description="mask: fuse argmax masks; proba: fuse softmax change probabilities"),
+    fusion: str = Form("vote", description="vote: count per-call detections (0/128/255); mean: average probabilities across calls (needs output_mode=proba)"),
+    tile_overlap: float = Form(0.0, description="Fraction of the crop size shared by neighbouring crops in calls > 1, in [0, 1)"),
+    blend: str = Form("cosine", description="Weighting of overlapping crops: cosine, linear or none"),
+    outputs: str = Form(",".join(OUTPUTS), description="Comma separated artifacts to return: mask, color_mask, overlay_a, overlay_b; the others are not rendered")
+):
+    """Form fields shared by /change-detection and /jobs, as keyword arguments of detect_uploads"""
+    return dict(
+        calls_nb=calls_nb, img_size=img_size, crop_image=crop_image, n=n,
+        batch_size=batch_size, precision=precision, channels_last=channels_last,
+        verify_precision=verify_precision, output_mode=output_mode, fusion=fusion,
+        tile_overlap=tile_overlap, blend=blend, outputs=outputs
+    )
+
+def params_error(images_a, images_b, params):
+    """Error message for invalid form fields, None if they are fine"""
+    if len(images_a) != len(images_b):
+        return "Number of images in A and B must be equal"
+    if params["batch_size"] < 1:
+        return "batch_size must be at least 1"
+    if params["precision"] not in ("fp32", "bf16", "fp16"):
+        return "precision must be one of fp32, bf16, fp16"
+    if (params["output_mode"] not in ("mask", "proba") or params["fusion"] not in ("vote", "mean")
+            or (params["fusion"] == "mean" and params["output_mode"] != "proba")):
+        return "output_mode must be mask or proba, fusion vote or mean (mean needs proba)"
+    if not 0 <= params["tile_overlap"] < 1 or params["blend"] not in ("cosine", "linear", "none"):
+        return "tile_overlap must be in [0, 1) and blend one of cosine, linear, none"
+    try:
+        parse_outputs(params["outputs"])
+    except ValueError as e:
+        return str(e)
+    return None
+
+def encoding_params(
+    mask_codec: str = Form("png", description="png: 8-bit grey PNG of the mask; png1: 1-bit / palette PNG; raw: uint8 bytes, shape in X-Array-Shape"),
+    image_codec: str = Form("png", description="Codec of the color mask and overlays: png, webp, jpeg or raw"),
+    png_level: int = Form(6, description="zlib compression level of PNG artifacts, 0 (fastest) to 9 (smallest)"),
+    quality: int = Form(80, description="Quality of WebP / JPEG artifacts, 0 to 100")
+):
+    """Form fields choosing how artifacts are encoded, as keyword arguments of Encoder"""
+    return dict(mask_codec=mask_codec, image_codec=image_codec, png_level=png_level, quality=quality)
+
+def encoding_error(encoding):
+    """Error message for invalid encoding fields, None if they are fine"""
+    if encoding["mask_codec"] not in MASK_CODECS or encoding["image_codec"] not in IMAGE_CODECS:
+        return "mask_codec must be one of %s, image_codec one of %s" % (", ".join(MASK_CODECS), ", ".join(IMAGE_CODECS))
+    if not 0 <= encoding["png_level"] <= 9 or not 0 <= encoding["quality"] <= 100:
+        return "png_level must be in [0, 9] and quality in [0, 100]"
+    return None
+
+async def read_uploads(images_a, images_b):
+    """[(filename, bytes_a, bytes_b)], read on the event loop"""
+    uploads = []
+    for i in range(len(images_a)):
+        uploads.append((images_a[i].filename, await images_a[i].read(), await images_b[i].read()))
+    return uploads
+
+def busy_response(e):
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Server is busy, retry later"},
+        headers={"Retry-After": str(e.retry_after)}
+    )
 
 @app.post("/change-detection")
 async def change_detection(
     images_a: List[UploadFile] = File(...), 
     images_b: List[UploadFile] = File(...),
-    img_size: int = Form(1024, description="Image size for processing (base size for first call)"),
-    n: int = Form(2, description="Number of crops per side for spatial tiling (total crops = n x n). Each piece in subsequent calls will be processed at current_img_size = img_size / (2^(call-1))"),
+    params: dict = Depends(detection_params),
+    encoding: dict = Depends(encoding_params),
     combine_masks: bool = Form(True, description="Combine cropped masks back into full images"),
-    calls_nb: int = Form(2, description="Number of model calls with decreasing img_size. Each call uses img_size / (2^(call-1)). For calls > 1, images are cropped into pieces where each piece size equals the current_img_size for that call."),
-    crop_image: bool = Form(True, description="Crop images for calls > 1. When True, images are cropped into pieces for processing in subsequent calls.")
+    response_format: str = Form("json", description="json: base64 artifacts in JSON; multipart / zip: artifacts streamed as each image finishes; raw: uint8 masks streamed as multipart")
 ):
     """
     Run change detection with multi-scale processing.
@@ -110,96 +234,238 @@ async def change_detection(
     - Call 1: Processes full image at img_size
     - Call 2+: Crops image into pieces where each piece size equals current_img_size
               (current_img_size = img_size / (2^(call-1)))
-              Number of pieces = (original_size / current_img_size)^2
+              Number of pieces = ceil(height / step) x ceil(width / step), with
+              step = current_img_size * (1 - tile_overlap); any rectangle is covered
+              and overlapping crops are blended
     
     Example with img_size=1024, calls_nb=3:
     - Call 1: 1 image at 1024×1024
     - Call 2: 4 images (2×2), each 512×512
     - Call 3: 16 images (4×4), each 256×256
     """
-    if len(images_a) != len(images_b):
-        return JSONResponse(
-            status_code=400,
-            content={"error": "Number of images in A and B must be equal"}
-        )
-    
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # Create directory structure
-        a_dir = os.path.join(temp_dir, 'A')
-        b_dir = os.path.join(temp_dir, 'B')
-        list_dir = os.path.join(temp_dir, 'list')
-        os.makedirs(a_dir)
-        os.makedirs(b_dir)
-        os.makedirs(list_dir)
-
-        # Save uploaded images
-        filenames = []
-        for i in range(len(images_a)):
-            filename = images_a[i].filename
-            filenames.append(filename)
-            with open(os.path.join(a_dir, filename), 'wb') as f:
-                f.write(await images_a[i].read())
-            with open(os.path.join(b_dir, filename), 'wb') as f:
-                f.write(await images_b[i].read())
-
-        # Create list/demo.txt
-        with open(os.path.join(list_dir, 'demo.txt'), 'w') as f:
-            for name in filenames:
-                f.write(name + '\n')
-
-        # Run change detection with provided values
-        output_folder = os.path.join(temp_dir, 'predicted')
-        # Auto-detect GPU availability
-        gpu_ids = '0' if torch.cuda.is_available() else '-1'  # -1 means CPU
-        run_change_detection(
-            data_dir=temp_dir,
-            calls_nb=calls_nb,
-            img_size=img_size,
-            crop_image=crop_image,
-            output_folder=output_folder,
+    error = params_error(images_a, images_b, params)
+    if error is None and response_format not in RESPONSE_FORMATS:
+        error = "response_format must be one of " + ", ".join(RESPONSE_FORMATS)
+    if error is None:
+        error = encoding_error(encoding)
+    if error is None and response_format == "raw" and "mask" not in parse_outputs(params["outputs"]):
+        error = "response_format raw streams the mask, outputs must include mask"
+    if error is not None:
+        return JSONResponse(status_code=400, content={"error": error})
+
+    # Read uploads on the event loop, then hand the blocking work to the inference pool
+    uploads = await read_uploads(images_a, images_b)
+
+    try:
+        if response_format != "json":
+            return stream_response(uploads, response_format, Encoder(**encoding), params)
+        results = await inference_executor.run(process_uploads, uploads, Encoder(**encoding), **params)
+    except QueueFullError as e:
+        return busy_response(e)
+
+    return JSONResponse(content={"results": results})
+
+@app.post("/jobs")
+async def submit_job(
+    images_a: List[UploadFile] = File(...),
+    images_b: List[UploadFile] = File(...),
+    params: dict = Depends(detection_params),
+    encoding: dict = Depends(encoding_params)
+):
+    """
+    Queue a change detection job and return its id immediately.
+    Poll GET /jobs/{id} for progress and fetch artifacts from GET /jobs/{id}/results/{name}.
+    """
+    error = params_error(images_a, images_b, params) or encoding_error(encoding)
+    if error is not None:
+        return JSONResponse(status_code=400, content={"error": error})
+
+    uploads = await read_uploads(images_a, images_b)
+    job = job_store.create([filename for filename, _, _ in uploads], params["calls_nb"])
+    try:
+        job_executor.submit(run_job, job, uploads, Encoder(**encoding), params)
+    except QueueFullError as e:
+        job_store.delete(job.id)
+        return busy_response(e)
+    return JSONResponse(status_code=202, content=job.to_dict())
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status, per-image / per-call progress and the artifact names of a job"""
+    job = job_store.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired job"})
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/results/{name}")
+async def get_job_result(job_id: str, name: str):
+    """One artifact of a finished image, e.g. {filename}_mask.png"""
+    job = job_store.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or expired job"})
+    result = job.result(name)
+    if result is None:
+        return JSONResponse(status_code=404, content={"error": "No such result (yet)"})
+    data, media_type, headers = result
+    return Response(content=data, media_type=media_type, headers=headers)
+
+def run_job(job, uploads, encoder, params):
+    """Worker side of /jobs: run the whole batch, recording progress and encoded artifacts."""
+    job.start()
+    try:
+        for filename, output in detect_uploads(uploads, progress=job.update, **params):
+            base = os.path.splitext(filename)[0]
+            for key, data, media_type, headers in encoder.encode_all(output, OUTPUTS):
+                job.add_result(encoder.filename(base, key), data, media_type, headers)
+    except Exception as e:
+        job.fail(e)
+        raise
+    job.finish()
+
+def stream_response(uploads, response_format, encoder, params):
+    """
+    Queue the uploads on the inference pool and stream each image's artifacts as soon as
+    it is done. Raises QueueFullError before anything is sent if the pool is full.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    writer = get_writer(response_format)
+    done = object()
+
+    def emit(chunk):
+        loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+
+    future = inference_executor.submit(stream_uploads, uploads, writer, response_format, encoder, emit, **params)
+    future.add_done_callback(lambda f: emit(done))
+
+    async def body():
+        while True:
+            chunk = await chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+        if future.exception() is not None:
+            raise future.exception()  # abort the stream, the client sees a truncated body
+        yield writer.close()
+
+    return StreamingResponse(body(), media_type=writer.media_type)
+
+def stream_uploads(uploads, writer, response_format, encoder, emit, **params):
+    """Process uploads one image at a time, emitting the encoded body chunks of each."""
+    for upload in uploads:
+        for filename, output in detect_uploads([upload], **params):
+            base = os.path.splitext(filename)[0]
+            if response_format == "raw":
+                mask = output["mask"]
+                emit(writer.write(base + "_mask.raw", mask.tobytes(), "application/octet-stream",
+                                  headers={"X-Array-Shape": "%d,%d" % mask.shape}))
+                continue
+            for key, data, media_type, headers in encoder.encode_all(output, OUTPUTS):
+                emit(writer.write(encoder.filename(base, key), data, media_type, headers=headers))
+
+def process_uploads(uploads, encoder, **params):
+    """Run change detection on [(filename, bytes_a, bytes_b)] and return base64 encoded results."""
+    # Prepare results with base64 encoded images
+    results = []
+    for filename, output in detect_uploads(uploads, **params):
+        base = os.path.splitext(filename)[0]
+
+        result_item = {
+            "filename": base,
+            "mask": None,
+            "color_mask": None,
+            "overlay_a": None,
+            "overlay_b": None
+        }
+
+        # Encode images to base64
+        for key, data, media_type, headers in encoder.encode_all(output, OUTPUTS):
+            result_item[key] = base64.b64encode(data).decode('utf-8')
+            result_item.setdefault("media_types", {})[key] = media_type
+            if "X-Array-Shape" in headers:
+                result_item.setdefault("shapes", {})[key] = headers["X-Array-Shape"]
+        if "precision_agreement" in output:
+            result_item["precision_agreement"] = output["precision_agreement"]
+
+        results.append(result_item)
+
+    return results
+
+def detect_uploads(uploads, calls_nb, img_size, crop_image, n, batch_size=4, precision='fp32',
+                   channels_last=False, verify_precision=False, output_mode='mask', fusion='vote',
+                   tile_overlap=0.0, blend='cosine', outputs=",".join(OUTPUTS), progress=None):
+    """
+    Run change detection on [(filename, bytes_a, bytes_b)]; returns [(filename, arrays)]
+    holding the requested outputs only. progress is passed on to run_change_detection_arrays.
+    Pairs already in the result cache are not run again: artifacts they lack are rendered
+    from the cached mask (and per-call masks) and added to the cache entry.
+    """
+    requested = parse_outputs(outputs)
+    params = dict(calls_nb=calls_nb, img_size=img_size, crop_image=crop_image, n=n, precision=precision,
+                  channels_last=channels_last, verify_precision=verify_precision, output_mode=output_mode,
+                  fusion=fusion, tile_overlap=tile_overlap, blend=blend)
+    results, keys = {}, {}
+    if result_cache is not None:
+        checkpoint = checkpoint_hash(CHECKPOINT_PATH)
+        for filename, data_a, data_b in uploads:
+            keys[filename] = result_key(data_a, data_b, params, checkpoint)
+            cached = result_cache.get(keys[filename])
+            if cached is None or ("color_mask" in requested and "color_mask" not in cached
+                                  and "call_masks" not in cached):
+                continue
+            missing = [key for key in requested if key not in cached]
+            if missing:
+                cached = dict(cached)
+                pair = None
+                if "overlay_a" in missing or "overlay_b" in missing:
+                    # the homography is in the alignment cache, only the warp runs again
+                    pair = get_aligner().align_arrays(decode_image(data_a), decode_image(data_b))
+                render_outputs(cached, missing, pair, output_mode)
+                result_cache.put(keys[filename], cached)
+            results[filename] = cached
+            if progress is not None:
+                progress('aligned', filename, None)
+                for call in range(1, calls_nb + 1):
+                    progress('inferred', filename, call)
+                progress('fused', filename, None)
+
+    # Decode uploads straight into arrays, nothing touches the filesystem
+    filenames, images_a, images_b = [], [], []
+    for filename, data_a, data_b in uploads:
+        if filename in results:
+            continue
+        filenames.append(filename)
+        images_a.append(decode_image(data_a))
+        images_b.append(decode_image(data_b))
+
+    if filenames:
+        computed = run_change_detection_arrays(
+            images_a, images_b, filenames,
+            aligner=get_aligner(),
             project_name='ChangeFormer_DSIFN',
             checkpoint_name='best_ckpt.pt',
-            gpu_ids=gpu_ids,
-            n=n
+            gpu_ids=get_gpu_ids(),
+            batch_size=batch_size,
+            outputs=requested,
+            keep_call_masks=result_cache is not None,
+            progress=progress,
+            batcher=batcher,
+            gate=gpu_gate,
+            **params
         )
+        for filename, output in computed.items():
+            results[filename] = output
+            if result_cache is not None:
+                result_cache.put(keys[filename], output)
 
-        # Prepare results with base64 encoded images
-        results = []
-        for filename in filenames:
-            base = os.path.splitext(filename)[0]
-            mask_path = os.path.join(output_folder, f"{base}.png")
-            color_mask_path = os.path.join(output_folder, f"{base}_color.png")
-            overlay_a_path = os.path.join(output_folder, f"{base}_A_overlay.png")
-            overlay_b_path = os.path.join(output_folder, f"{base}_B_overlay.png")
-
-            result_item = {
-                "filename": base,
-                "mask": None,
-                "color_mask": None,
-                "overlay_a": None,
-                "overlay_b": None
-            }
-
-            # Encode images to base64
-            if os.path.exists(mask_path):
-                with open(mask_path, 'rb') as f:
-                    result_item["mask"] = base64.b64encode(f.read()).decode('utf-8')
-            
-            if os.path.exists(color_mask_path):
-                with open(color_mask_path, 'rb') as f:
-                    result_item["color_mask"] = base64.b64encode(f.read()).decode('utf-8')
-            
-            if os.path.exists(overlay_a_path):
-                with open(overlay_a_path, 'rb') as f:
-                    result_item["overlay_a"] = base64.b64encode(f.read()).decode('utf-8')
-            
-            if os.path.exists(overlay_b_path):
-                with open(overlay_b_path, 'rb') as f:
-                    result_item["overlay_b"] = base64.b64encode(f.read()).decode('utf-8')
-
-            results.append(result_item)
-
-        return JSONResponse(content={"results": results})
+    extras = ("precision_agreement",)
+    return [(filename, {key: value for key, value in results.get(filename, {}).items()
+                        if key in requested or key in extras})
+            for filename, _, _ in uploads]
+
+def decode_image(data):
+    """Decode uploaded image bytes to an RGB uint8 array"""
+    return np.asarray(Image.open(BytesIO(data)).convert('RGB'))
 
 
 # uvicorn api:app --reload  
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""
+Encoding of result arrays (masks, color masks, overlays) into output files.
+
+Codecs: 'png' (lossless, 8-bit), 'png1' (masks only: masks with at most 16
+levels are written as 1-bit or palette PNGs), 'webp' and 'jpeg' (lossy, for the
+color mask and overlays) and 'raw' (the array bytes, no encoding). An Encoder picks the codec of every
+artifact and encodes the artifacts of an image in parallel on a thread pool;
+zlib and libwebp release the GIL while they compress.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+
+CODECS = ('png', 'png1', 'webp', 'jpeg', 'raw')
+MASK_CODECS = ('png', 'png1', 'raw')
+IMAGE_CODECS = ('png', 'webp', 'jpeg', 'raw')
+MEDIA_TYPES = {'png': 'image/png', 'png1': 'image/png', 'webp': 'image/webp', 'jpeg': 'image/jpeg',
+               'raw': 'application/octet-stream'}
+EXTENSIONS = {'png': 'png', 'png1': 'png', 'webp': 'webp', 'jpeg': 'jpg', 'raw': 'raw'}
+DEFAULT_LEVELS = {'png': 6, 'png1': 6, 'webp': 80, 'jpeg': 85}  # zlib level 0-9, quality 0-100
+PNG_CODECS = ('png', 'png1')
+MASK_KEYS = ('mask',)
+
+
+def _compact_mask(mask):
+    """(1-bit or palette image, PNG bit depth) of a uint8 mask with at most 16 levels, else None."""
+    counts = np.bincount(mask.ravel(), minlength=256)
+    levels = np.flatnonzero(counts)
+    if len(levels) > 16:
+        return None
+    if set(levels.tolist()) <= {0, 255}:
+        packed = np.packbits(mask > 127, axis=1)
+        return Image.frombytes('1', (mask.shape[1], mask.shape[0]), packed.tobytes()), 1
+    index = np.zeros(256, dtype=np.uint8)
+    index[levels] = np.arange(len(levels), dtype=np.uint8)
+    image = Image.fromarray(index[mask], 'P')
+    image.putpalette(np.repeat(levels, 3).astype(np.uint8).tobytes())
+    return image, 1 if len(levels) <= 2 else 2 if len(levels) <= 4 else 4
+
+
+def encode_array(array, codec='png', level=None):
+    """
+    Encode an (H, W) or (H, W, 3 / 4) uint8 array; level is the PNG zlib level or the
+    WebP / JPEG quality (codec default if None). Opaque RGBA is written as RGB by the
+    lossy codecs.
+    """
+    if codec == 'raw':
+        return np.ascontiguousarray(array).tobytes()
+    if codec not in CODECS:
+        raise ValueError('codec must be one of ' + ', '.join(CODECS))
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+
+    buffer = BytesIO()
+    if codec in PNG_CODECS:
+        compact = _compact_mask(array) if codec == 'png1' and array.ndim == 2 else None
+        if compact is None:
+            image, options = Image.fromarray(array), {}
+        else:
+            image, bits = compact
+            options = {'bits': bits} if image.mode == 'P' else {}
+        image.save(buffer, format='PNG', compress_level=level, **options)
+        return buffer.getvalue()
+
+    if array.ndim == 3 and array.shape[2] == 4 and array[..., 3].min() == 255:
+        array = array[..., :3]
+    Image.fromarray(array).save(buffer, format='WEBP' if codec == 'webp' else 'JPEG', quality=level)
+    return buffer.getvalue()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def encode_pool():
+    """Thread pool shared by all Encoders, CD_ENCODE_THREADS workers (default 4)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=int(os.environ.get('CD_ENCODE_THREADS', 4)),
+                                       thread_name_prefix='encode')
+    return _pool
+
+
+class Encoder:
+    """
+    mask_codec: codec of the 'mask' artifact ('png', 'png1' or 'raw').
+    image_codec: codec of every other artifact (color mask, overlays).
+    png_level: zlib level 0-9 of PNG artifacts; quality: 0-100 quality of WebP / JPEG ones
+    (None for the codec defaults).
+    """
+
+    def __init__(self, mask_codec='png', image_codec='png', png_level=None, quality=None):
+        if mask_codec not in MASK_CODECS:
+            raise ValueError('mask_codec must be one of ' + ', '.join(MASK_CODECS))
+        if image_codec not in IMAGE_CODECS:
+            raise ValueError('image_codec must be one of ' + ', '.join(IMAGE_CODECS))
+        self.mask_codec = mask_codec
+        self.image_codec = image_codec
+        self.png_level = png_level
+        self.quality = quality
+
+    def codec(self, key):
+        return self.mask_codec if key in MASK_KEYS else self.image_codec
+
+    def filename(self, base, key):
+        return '%s_%s.%s' % (base, key, EXTENSIONS[self.codec(key)])
+
+    def encode(self, key, array):
+        """(data, media type, headers) of one artifact; raw artifacts carry their shape in X-Array-Shape."""
+        codec = self.codec(key)
+        headers = {'X-Array-Shape': ','.join(str(d) for d in array.shape)} if codec == 'raw' else {}
+        level = self.png_level if codec in PNG_CODECS else self.quality
+        return encode_array(array, codec, level), MEDIA_TYPES[codec], headers
+
+    def encode_all(self, output, keys):
+        """[(key, data, media type, headers)] of the keys present in output, encoded in parallel."""
+        keys = [key for key in keys if key in output]
+        futures = [encode_pool().submit(self.encode, key, output[key]) for key in keys]
+        return [(key,) + future.result() for key, future in zip(keys, futures)]
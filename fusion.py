@@ -0,0 +1,142 @@
+"""
+Fusion of the per-call (multi-scale) masks of one image.
+
+Masks are processed in row strips, so the temporaries stay a few strips in size
+whatever the image size. In 'mask' mode every call's detection is packed as one
+bit of a per-pixel code, and both the vote level and the color come from a
+lookup table indexed by that code. Probabilities are quantized to uint8 levels
+and colorized through a per-call (256, 3) table accumulated in uint16.
+"""
+
+import numpy as np
+
+
+CALL_COLORS = ((0, 255, 0), (0, 0, 255))  # green for call 1, blue for call 2, then repeating
+VOTE_LEVELS = (0, 128, 255)  # detected by 0, 1, 2 or more calls
+
+_POPCOUNT = np.array([bin(code).count('1') for code in range(1 << 16)], dtype=np.uint8)
+
+
+def vote_lut(n_masks):
+    """bw level of every detection code of n_masks bits."""
+    counts = _POPCOUNT[:1 << n_masks]
+    return np.asarray(VOTE_LEVELS, dtype=np.uint8)[np.minimum(counts, len(VOTE_LEVELS) - 1)]
+
+
+def color_lut(n_masks, colors=CALL_COLORS):
+    """RGB color of every detection code of n_masks bits (sum of the detected calls' colors)."""
+    lut = np.zeros((1 << n_masks, 3), dtype=np.uint16)
+    codes = np.arange(1 << n_masks)
+    for i in range(n_masks):
+        lut[(codes >> i) & 1 == 1] += np.asarray(colors[i % len(colors)], dtype=np.uint16)
+    return np.minimum(lut, 255).astype(np.uint8)
+
+
+def level_luts(n_masks, colors=CALL_COLORS):
+    """Per call, the (256, 3) color contribution of every uint8 probability level."""
+    levels = np.arange(256, dtype=np.uint32)[:, None]
+    return [((levels * np.asarray(colors[i % len(colors)], dtype=np.uint32) + 127) // 255).astype(np.uint16)
+            for i in range(n_masks)]
+
+
+def quantize(mask):
+    """uint8 0-255 levels of a mask or probability strip in [0, 1] (uint8 input is returned as is)."""
+    if mask.dtype == np.uint8:
+        return mask
+    levels = np.multiply(mask, 255, dtype=np.float32)
+    levels += 0.5
+    np.clip(levels, 0, 255, out=levels)
+    return levels.astype(np.uint8)
+
+
+def detected(mask):
+    """
+    Boolean detections of a strip: above 0.5 for float masks (argmax * 255 masks, whose
+    interpolated edges count as detected, or [0, 1] probabilities), above 127 for uint8.
+    """
+    return mask > 127 if mask.dtype == np.uint8 else mask > 0.5
+
+
+def binarize(mask, threshold=127):
+    """
+    In place, 255 where a blended argmax * 255 map is above threshold (most of the
+    overlapping tiles detect the pixel), 0 elsewhere; returns mask.
+    """
+    hits = mask > threshold
+    mask[...] = 0
+    mask[hits] = 255
+    return mask
+
+
+def quantize_stack(masks_list, output_mode='mask', rows=512):
+    """
+    (calls, H, W) uint8 per-call masks that fuse_masks colorizes like the originals:
+    detections as 0 / 255 in 'mask' mode, 0-255 probability levels in 'proba' mode.
+    """
+    h, w = masks_list[0].shape
+    stack = np.empty((len(masks_list), h, w), dtype=np.uint8)
+    for i, mask in enumerate(masks_list):
+        for top in range(0, h, rows):
+            strip = mask[top:top + rows]
+            if output_mode == 'proba':
+                stack[i, top:top + rows] = quantize(strip)
+            else:
+                np.multiply(detected(strip), 255, out=stack[i, top:top + rows], casting='unsafe')
+    return stack
+
+
+def fuse_masks(masks_list, output_mode='mask', fusion='vote', colors=CALL_COLORS, rows=512, color=True):
+    """
+    Combine the per-call masks of one image into (bw_mask, color_mask), both uint8.
+
+    masks_list: (H, W) masks in call order: uint8 0 / 255 detections (as assembled by
+    run.assemble_call_masks) or float argmax * 255 masks in 'mask' mode; uint8 0-255 or
+    float [0, 1] probabilities in 'proba' mode.
+    fusion: 'vote' gives 0 / 128 / 255 for pixels detected by 0 / 1 / 2+ calls, 'mean'
+    the mean probability as a 0-255 confidence.
+    colors: RGB color of each call in the color mask.
+    rows: height of the strips processed at once.
+    color: False skips the color mask (returned as None).
+    """
+    n_masks = len(masks_list)
+    if not 0 < n_masks <= 16:
+        raise ValueError('between 1 and 16 masks can be fused')
+    h, w = masks_list[0].shape
+    bw_mask = np.empty((h, w), dtype=np.uint8)
+    color_mask = np.empty((h, w, 3), dtype=np.uint8) if color else None
+
+    code_dtype = np.uint8 if n_masks <= 8 else np.uint16
+    votes = vote_lut(n_masks)
+    # Binary masks only have 2 ** n_masks possible colors; probabilities keep their intensity
+    binary = output_mode != 'proba'
+    colors_by_code = color_lut(n_masks, colors) if binary else None
+    colors_by_level = None if binary else level_luts(n_masks, colors)
+
+    for top in range(0, h, rows):
+        strips = [mask[top:top + rows] for mask in masks_list]
+        code = np.zeros(strips[0].shape, dtype=code_dtype)
+        for i, strip in enumerate(strips):
+            code |= detected(strip).astype(code_dtype) << i
+
+        if fusion == 'mean':
+            total = np.zeros(code.shape, dtype=np.uint16)
+            for strip in strips:
+                total += quantize(strip)
+            total += n_masks // 2
+            total //= n_masks
+            bw_mask[top:top + rows] = total
+        else:
+            bw_mask[top:top + rows] = votes[code]
+
+        if not color:
+            continue
+        if binary:
+            color_mask[top:top + rows] = colors_by_code[code]
+        else:
+            total = np.zeros(code.shape + (3,), dtype=np.uint16)
+            for strip, lut in zip(strips, colors_by_level):
+                total += lut[quantize(strip)]
+            np.minimum(total, 255, out=total)
+            color_mask[top:top + rows] = total
+
+    return bw_mask, color_mask
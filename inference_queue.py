@@ -0,0 +1,98 @@
+"""
+Bounded executor that keeps blocking inference off the asyncio event loop.
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """Raised when the executor already holds as many jobs as it accepts."""
+
+    def __init__(self, retry_after):
+        super(QueueFullError, self).__init__('inference queue is full')
+        self.retry_after = retry_after
+
+
+class InferenceExecutor:
+    """
+    Runs synchronous jobs on a dedicated thread pool.
+
+    At most `concurrency` jobs run at the same time and at most `max_queue`
+    more wait for a worker; further submissions raise QueueFullError so the
+    caller can answer 503 instead of piling up work on the GPU.
+    """
+
+    def __init__(self, concurrency=1, max_queue=4, retry_after=10):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='inference')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'concurrency': self.concurrency,
+                'max_queue': self.max_queue,
+                'running': self._running,
+                'queued': self._pending - self._running,
+            }
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) and return a concurrent.futures.Future."""
+        with self._lock:
+            if self._pending >= self.concurrency + self.max_queue:
+                raise QueueFullError(self.retry_after)
+            self._pending += 1
+
+        try:
+            future = self._pool.submit(self._run, fn, args, kwargs)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            raise
+        # released when the job really finishes, even if the awaiting client went away
+        future.add_done_callback(self._release)
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Await fn(*args, **kwargs) executed on the inference pool."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _run(self, fn, args, kwargs):
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+def gpu_gate_from_env():
+    """
+    Semaphore admitting CD_INFERENCE_CONCURRENCY forward passes at once, shared by the
+    /change-detection and /jobs pools so that their limits do not add up on the GPU.
+    """
+    return threading.BoundedSemaphore(int(os.environ.get('CD_INFERENCE_CONCURRENCY', 1)))
+
+
+def executor_from_env():
+    """Build an InferenceExecutor configured through CD_INFERENCE_* environment variables."""
+    return InferenceExecutor(
+        concurrency=int(os.environ.get('CD_INFERENCE_CONCURRENCY', 1)),
+        max_queue=int(os.environ.get('CD_INFERENCE_QUEUE_SIZE', 4)),
+        retry_after=int(os.environ.get('CD_INFERENCE_RETRY_AFTER', 10)),
+    )
@@ -0,0 +1,109 @@
+"""
+In-process store of asynchronous change detection jobs.
+
+A Job records its status, per-image / per-call progress and the encoded artifacts
+of every finished image. The JobStore drops jobs `ttl` seconds after they ended.
+"""
+
+import threading
+import time
+import uuid
+
+
+class Job:
+    """State of one /jobs submission, updated from the worker thread."""
+
+    def __init__(self, names, calls_nb):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.calls_nb = calls_nb
+        self._lock = threading.Lock()
+        self._progress = {name: {'aligned': False, 'calls_done': [], 'done': False} for name in names}
+        self._results = {}  # name -> (bytes, media type, headers)
+
+    def start(self):
+        with self._lock:
+            self.status = 'running'
+
+    def update(self, stage, name, call=None):
+        """
+        Progress callback of run_change_detection_arrays ('aligned', 'inferred', 'fused');
+        name is one of the upload filenames the job was created with.
+        """
+        with self._lock:
+            progress = self._progress[name]
+            if stage == 'aligned':
+                progress['aligned'] = True
+            elif stage == 'inferred' and call not in progress['calls_done']:
+                progress['calls_done'].append(call)
+            elif stage == 'fused':
+                progress['done'] = True
+
+    def add_result(self, name, data, media_type, headers=None):
+        with self._lock:
+            self._results[name] = (data, media_type, headers or {})
+
+    def result(self, name):
+        with self._lock:
+            return self._results.get(name)
+
+    def finish(self):
+        with self._lock:
+            self.status = 'done'
+            self.finished = time.time()
+
+    def fail(self, error):
+        with self._lock:
+            self.status = 'failed'
+            self.error = str(error)
+            self.finished = time.time()
+
+    def to_dict(self):
+        with self._lock:
+            steps = self.calls_nb + 2  # align, every call, fuse
+            completed = sum(p['aligned'] + len(p['calls_done']) + p['done'] for p in self._progress.values())
+            return {
+                'id': self.id,
+                'status': self.status,
+                'error': self.error,
+                'created': self.created,
+                'finished': self.finished,
+                'progress': completed / float(max(1, steps * len(self._progress))),
+                'images': {name: dict(p, calls_done=sorted(p['calls_done'])) for name, p in self._progress.items()},
+                'results': sorted(self._results),
+            }
+
+
+class JobStore:
+    """Thread-safe id -> Job map evicting jobs `ttl` seconds after they finished."""
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, names, calls_nb):
+        job = Job(names, calls_nb)
+        with self._lock:
+            self._evict()
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._evict()
+            return self._jobs.get(job_id)
+
+    def delete(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _evict(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished is not None and now - job.finished > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
@@ -0,0 +1,122 @@
+"""
+Dynamic batching of same-size tiles across concurrent requests.
+
+Request threads hand their preprocessed tile pairs to a MicroBatcher; a single
+dispatcher thread waits up to `window_ms` for other requests with tiles of the
+same size and model settings, runs them as one forward pass and routes every
+mask back to the request that submitted it.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+
+def batch_key(model, img_size):
+    """Tiles may share a forward pass only if everything affecting it matches."""
+    return (id(model.net_G), img_size, model.precision, model.channels_last,
+            getattr(model.args, 'siamese_fusion', False), model.output_mode,
+            model.proba_dtype, model.verify_precision)
+
+
+class _Item:
+    __slots__ = ('model', 'key', 'tensors', 'max_batch', 'future')
+
+    def __init__(self, model, key, tensors, max_batch):
+        self.model = model
+        self.key = key
+        self.tensors = tensors
+        self.max_batch = max_batch
+        self.future = Future()
+
+
+class MicroBatcher:
+    """
+    Collects tiles from concurrent callers into batches of at most the caller's
+    batch_size, waiting at most window_ms for a batch to fill up.
+    """
+
+    def __init__(self, window_ms=10):
+        self.window = window_ms / 1000.0
+        self._items = []
+        self._cond = threading.Condition()
+        self._batches = 0
+        self._tiles = 0
+        self._thread = threading.Thread(target=self._loop, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'window_ms': self.window * 1000.0,
+                'batches': self._batches,
+                'tiles': self._tiles,
+                'mean_batch': self._tiles / float(self._batches) if self._batches else 0.0,
+                'waiting': len(self._items),
+            }
+
+    def infer(self, model, tensor_pairs, img_size, batch_size=1):
+        """
+        Run model on preprocessed (tensor_a, tensor_b) pairs, possibly batched with
+        other callers; returns [(mask, fp32 agreement or None)] in input order.
+        """
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        key = batch_key(model, img_size)
+        items = [_Item(model, key, pair, batch_size) for pair in tensor_pairs]
+        with self._cond:
+            self._items.extend(items)
+            self._cond.notify()
+        return [item.future.result() for item in items]
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._items:
+                    self._cond.wait()
+                first = self._items[0]
+                deadline = time.monotonic() + self.window
+                while True:
+                    batch = [item for item in self._items if item.key == first.key][:first.max_batch]
+                    remaining = deadline - time.monotonic()
+                    if len(batch) >= first.max_batch or remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if not batch:
+                    # max_batch < 1 never selects anything: fail the item rather than spin on it
+                    self._items.remove(first)
+                    first.future.set_exception(ValueError('batch_size must be at least 1'))
+                    continue
+                for item in batch:
+                    self._items.remove(item)
+                self._batches += 1
+                self._tiles += len(batch)
+            self._run(batch)
+
+    def _run(self, batch):
+        try:
+            model = batch[0].model
+            score_map = model._forward_pass({'A': torch.stack([item.tensors[0] for item in batch]),
+                                             'B': torch.stack([item.tensors[1] for item in batch])})
+            score_map = score_map[:, 0].cpu().numpy()
+            if model.output_mode != 'proba':
+                score_map = score_map.astype(np.float32)
+            agreement = [None] * len(batch)
+            if model.precision_agreement is not None:
+                agreement = model.precision_agreement.cpu().tolist()
+        except BaseException as e:
+            for item in batch:
+                item.future.set_exception(e)
+            return
+        for item, mask, agree in zip(batch, score_map, agreement):
+            item.future.set_result((mask, agree))
+
+
+def batcher_from_env():
+    """MicroBatcher with a CD_BATCH_WINDOW_MS window (default 10), None if it is 0."""
+    window_ms = float(os.environ.get('CD_BATCH_WINDOW_MS', 10))
+    return MicroBatcher(window_ms) if window_ms > 0 else None
@@ -20,6 +20,15 @@ from scipy.io import savemat
 
 from models.pixel_shuffel_up import PS_UP
 
+try:
+    from torch.nn.attention import sdpa_kernel, SDPBackend
+except ImportError:  # torch < 2.3
+    sdpa_kernel, SDPBackend = None, None
+
+# eager: explicit q @ k.T softmax; sdpa: F.scaled_dot_product_attention with any kernel;
+# mem_efficient: SDPA restricted to kernels that never materialise the attention matrix
+ATTENTION_BACKENDS = ('eager', 'sdpa', 'mem_efficient')
+
 class EncoderTransformer(nn.Module):
     def __init__(self, img_size=256, patch_size=16, in_chans=3, num_classes=2, embed_dims=[64, 128, 256, 512],
                  num_heads=[1, 2, 4, 8], mlp_ratios=[4, 4, 4, 4], qkv_bias=False, qk_scale=None, drop_rate=0.,
@@ -296,9 +305,12 @@ class Mlp(nn.Module):
 
 
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., sr_ratio=1):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., sr_ratio=1,
+                 attn_backend='eager'):
         super().__init__()
         assert dim % num_heads == 0, f"dim {dim} should be divided by num_heads {num_heads}."
+        assert attn_backend in ATTENTION_BACKENDS, f"unknown attention backend {attn_backend}."
+        self.attn_backend = attn_backend
 
         self.dim = dim
         self.num_heads = num_heads
@@ -347,16 +359,62 @@ class Attention(nn.Module):
             kv = self.kv(x).reshape(B, -1, 2, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         k, v = kv[0], kv[1]
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if self.attn_backend == 'eager':
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
+        else:
+            x = self._sdpa(q, k, v)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
 
         return x
 
+    def _sdpa(self, q, k, v):
+        dropout_p = self.attn_drop.p if self.training else 0.
+        if self.attn_backend == 'mem_efficient' and sdpa_kernel is not None:
+            if q.device.type == 'cuda':
+                backends = [SDPBackend.EFFICIENT_ATTENTION, SDPBackend.FLASH_ATTENTION]
+            else:
+                # the CPU flash kernel is tiled; without math, an unsupported dtype raises and
+                # the registry's parity check falls back to eager
+                backends = [SDPBackend.FLASH_ATTENTION]
+            with sdpa_kernel(backends):
+                return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, scale=self.scale)
+        return F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, scale=self.scale)
+
+
+def set_attention_backend(net, attn_backend):
+    """Switch every encoder Attention layer in net to attn_backend (see ATTENTION_BACKENDS)."""
+    assert attn_backend in ATTENTION_BACKENDS, f"unknown attention backend {attn_backend}."
+    for m in net.modules():
+        if isinstance(m, Attention):
+            m.attn_backend = attn_backend
+    return net
+
+
+@torch.no_grad()
+def check_attention_parity(net, attn_backend, img_size=128, device=None):
+    """
+    Run net on a random pair with the eager attention and with attn_backend and
+    return the max absolute difference of the final change logits.
+    The network is left on attn_backend.
+    """
+    if device is None:
+        device = next(net.parameters()).device
+    dtype = next(net.parameters()).dtype
+    x1 = torch.randn(1, 3, img_size, img_size, device=device, dtype=dtype)
+    x2 = torch.randn(1, 3, img_size, img_size, device=device, dtype=dtype)
+
+    set_attention_backend(net, 'eager')
+    reference = net(x1, x2)[-1]
+    set_attention_backend(net, attn_backend)
+    output = net(x1, x2)[-1]
+    return (output - reference).abs().max().item()
+
 
 class Attention_dec(nn.Module):
     def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., sr_ratio=1):
@@ -472,13 +530,13 @@ class Block_dec(nn.Module):
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, sr_ratio=1):
+                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, sr_ratio=1, attn_backend='eager'):
         super().__init__()
         self.norm1 = norm_layer(dim)
         self.attn = Attention(
             dim,
             num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale,
-            attn_drop=attn_drop, proj_drop=drop, sr_ratio=sr_ratio)
+            attn_drop=attn_drop, proj_drop=drop, sr_ratio=sr_ratio, attn_backend=attn_backend)
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -1332,7 +1390,7 @@ class EncoderTransformer_v3(nn.Module):
     def __init__(self, img_size=256, patch_size=3, in_chans=3, num_classes=2, embed_dims=[32, 64, 128, 256],
                  num_heads=[2, 2, 4, 8], mlp_ratios=[4, 4, 4, 4], qkv_bias=True, qk_scale=None, drop_rate=0.,
                  attn_drop_rate=0., drop_path_rate=0., norm_layer=nn.LayerNorm,
-                 depths=[3, 3, 6, 18], sr_ratios=[8, 4, 2, 1]):
+                 depths=[3, 3, 6, 18], sr_ratios=[8, 4, 2, 1], attn_backend='eager'):
         super().__init__()
         self.num_classes    = num_classes
         self.depths         = depths
@@ -1354,7 +1412,7 @@ class EncoderTransformer_v3(nn.Module):
         self.block1 = nn.ModuleList([Block(
             dim=embed_dims[0], num_heads=num_heads[0], mlp_ratio=mlp_ratios[0], qkv_bias=qkv_bias, qk_scale=qk_scale,
             drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[cur + i], norm_layer=norm_layer,
-            sr_ratio=sr_ratios[0])
+            sr_ratio=sr_ratios[0], attn_backend=attn_backend)
             for i in range(depths[0])])
         self.norm1 = norm_layer(embed_dims[0])
         
@@ -1363,7 +1421,7 @@ class EncoderTransformer_v3(nn.Module):
         self.block2 = nn.ModuleList([Block(
             dim=embed_dims[1], num_heads=num_heads[1], mlp_ratio=mlp_ratios[1], qkv_bias=qkv_bias, qk_scale=qk_scale,
             drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[cur + i], norm_layer=norm_layer,
-            sr_ratio=sr_ratios[1])
+            sr_ratio=sr_ratios[1], attn_backend=attn_backend)
             for i in range(depths[1])])
         self.norm2 = norm_layer(embed_dims[1])
        
@@ -1372,7 +1430,7 @@ class EncoderTransformer_v3(nn.Module):
         self.block3 = nn.ModuleList([Block(
             dim=embed_dims[2], num_heads=num_heads[2], mlp_ratio=mlp_ratios[2], qkv_bias=qkv_bias, qk_scale=qk_scale,
             drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[cur + i], norm_layer=norm_layer,
-            sr_ratio=sr_ratios[2])
+            sr_ratio=sr_ratios[2], attn_backend=attn_backend)
             for i in range(depths[2])])
         self.norm3 = norm_layer(embed_dims[2])
         
@@ -1381,7 +1439,7 @@ class EncoderTransformer_v3(nn.Module):
         self.block4 = nn.ModuleList([Block(
             dim=embed_dims[3], num_heads=num_heads[3], mlp_ratio=mlp_ratios[3], qkv_bias=qkv_bias, qk_scale=qk_scale,
             drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[cur + i], norm_layer=norm_layer,
-            sr_ratio=sr_ratios[3])
+            sr_ratio=sr_ratios[3], attn_backend=attn_backend)
             for i in range(depths[3])])
         self.norm4 = norm_layer(embed_dims[3])
 
@@ -1544,6 +1602,10 @@ class DecoderTransformer_v3(nn.Module):
 
         return inputs
 
+    def _embed(self, linear, c):
+        # MLP head, back to (n, embedding_dim, h, w)
+        return linear(c).permute(0,2,1).reshape(c.shape[0], -1, c.shape[2], c.shape[3])
+
     def forward(self, inputs1, inputs2):
         #Transforming encoder features (select layers)
         x_1 = self._transform_inputs(inputs1)  # len=4, 1/2, 1/4, 1/8, 1/16
@@ -1554,36 +1616,51 @@ class DecoderTransformer_v3(nn.Module):
         c1_2, c2_2, c3_2, c4_2 = x_2
 
         ############## MLP decoder on C1-C4 ###########
-        n, _, h, w = c4_1.shape
+        _c4_1, _c4_2 = self._embed(self.linear_c4, c4_1), self._embed(self.linear_c4, c4_2)
+        _c3_1, _c3_2 = self._embed(self.linear_c3, c3_1), self._embed(self.linear_c3, c3_2)
+        _c2_1, _c2_2 = self._embed(self.linear_c2, c2_1), self._embed(self.linear_c2, c2_2)
+        _c1_1, _c1_2 = self._embed(self.linear_c1, c1_1), self._embed(self.linear_c1, c1_2)
+
+        return self._decode((_c1_1, _c2_1, _c3_1, _c4_1), (_c1_2, _c2_2, _c3_2, _c4_2))
+
+    def forward_fused(self, inputs):
+        """
+        Same as forward, for the features of both images concatenated along the batch
+        axis (pre images first): every MLP head runs once on the whole batch and its
+        output is split before the difference modules.
+        """
+        x = self._transform_inputs(inputs)  # len=4, 1/2, 1/4, 1/8, 1/16
+
+        ############## MLP decoder on C1-C4 ###########
+        linear_heads = [self.linear_c1, self.linear_c2, self.linear_c3, self.linear_c4]
+        embeds = [self._embed(linear, c).chunk(2, dim=0) for linear, c in zip(linear_heads, x)]
+
+        return self._decode([e[0] for e in embeds], [e[1] for e in embeds])
+
+    def _decode(self, embeds1, embeds2):
+        _c1_1, _c2_1, _c3_1, _c4_1 = embeds1
+        _c1_2, _c2_2, _c3_2, _c4_2 = embeds2
 
         outputs = []
         # Stage 4: x1/32 scale
-        _c4_1 = self.linear_c4(c4_1).permute(0,2,1).reshape(n, -1, c4_1.shape[2], c4_1.shape[3])
-        _c4_2 = self.linear_c4(c4_2).permute(0,2,1).reshape(n, -1, c4_2.shape[2], c4_2.shape[3])
         _c4   = self.diff_c4(torch.cat((_c4_1, _c4_2), dim=1))
         p_c4  = self.make_pred_c4(_c4)
         outputs.append(p_c4)
-        _c4_up= resize(_c4, size=c1_2.size()[2:], mode='bilinear', align_corners=False)
+        _c4_up= resize(_c4, size=_c1_2.size()[2:], mode='bilinear', align_corners=False)
 
         # Stage 3: x1/16 scale
-        _c3_1 = self.linear_c3(c3_1).permute(0,2,1).reshape(n, -1, c3_1.shape[2], c3_1.shape[3])
-        _c3_2 = self.linear_c3(c3_2).permute(0,2,1).reshape(n, -1, c3_2.shape[2], c3_2.shape[3])
         _c3   = self.diff_c3(torch.cat((_c3_1, _c3_2), dim=1)) + F.interpolate(_c4, scale_factor=2, mode="bilinear")
         p_c3  = self.make_pred_c3(_c3)
         outputs.append(p_c3)
-        _c3_up= resize(_c3, size=c1_2.size()[2:], mode='bilinear', align_corners=False)
+        _c3_up= resize(_c3, size=_c1_2.size()[2:], mode='bilinear', align_corners=False)
 
         # Stage 2: x1/8 scale
-        _c2_1 = self.linear_c2(c2_1).permute(0,2,1).reshape(n, -1, c2_1.shape[2], c2_1.shape[3])
-        _c2_2 = self.linear_c2(c2_2).permute(0,2,1).reshape(n, -1, c2_2.shape[2], c2_2.shape[3])
         _c2   = self.diff_c2(torch.cat((_c2_1, _c2_2), dim=1)) + F.interpolate(_c3, scale_factor=2, mode="bilinear")
         p_c2  = self.make_pred_c2(_c2)
         outputs.append(p_c2)
-        _c2_up= resize(_c2, size=c1_2.size()[2:], mode='bilinear', align_corners=False)
+        _c2_up= resize(_c2, size=_c1_2.size()[2:], mode='bilinear', align_corners=False)
 
         # Stage 1: x1/4 scale
-        _c1_1 = self.linear_c1(c1_1).permute(0,2,1).reshape(n, -1, c1_1.shape[2], c1_1.shape[3])
-        _c1_2 = self.linear_c1(c1_2).permute(0,2,1).reshape(n, -1, c1_2.shape[2], c1_2.shape[3])
         _c1   = self.diff_c1(torch.cat((_c1_1, _c1_2), dim=1)) + F.interpolate(_c2, scale_factor=2, mode="bilinear")
         p_c1  = self.make_pred_c1(_c1)
         outputs.append(p_c1)
@@ -1677,7 +1754,12 @@ class ChangeFormerV6(nn.Module):
                     in_channels = self.embed_dims, embedding_dim= self.embedding_dim, output_nc=output_nc, 
                     decoder_softmax = decoder_softmax, feature_strides=[2, 4, 8, 16])
 
-    def forward(self, x1, x2):
+    def forward(self, x1, x2, siamese_fusion=False):
+
+        if siamese_fusion:
+            # One encoder / MLP-head pass over both dates stacked on the batch axis
+            fx = self.Tenc_x2(torch.cat((x1, x2), dim=0))
+            return self.TDec_x2.forward_fused(fx)
 
         [fx1, fx2] = [self.Tenc_x2(x1), self.Tenc_x2(x2)]
 
@@ -1,8 +1,10 @@
+import contextlib
 import os
 
 import torch
 
 from misc.imutils import save_image
+from models import model_registry
 from models.networks import *
 
 
@@ -10,16 +12,26 @@ class CDEvaluator():
 
     def __init__(self, args):
 
+        self.args = args
         self.n_class = args.n_class
-        # define G
-        self.net_G = define_G(args=args, gpu_ids=args.gpu_ids)
+        # G is shared through the model registry and bound in load_checkpoint
+        self.net_G = None
 
-        self.device = torch.device("cuda:%s" % args.gpu_ids[0]
-                                   if torch.cuda.is_available() and len(args.gpu_ids)>0
-                                   else "cpu")
+        self.device = model_registry.get_device(args.gpu_ids)
 
         print(self.device)
 
+        # inference mode: fp32 | bf16 | fp16 autocast, channels-last tensors and an
+        # optional fp32 reference pass to measure how often the argmax masks agree
+        self.precision = self._resolve_precision(getattr(args, 'precision', 'fp32'))
+        self.channels_last = getattr(args, 'channels_last', False)
+        self.verify_precision = getattr(args, 'verify_precision', False)
+        self.precision_agreement = None
+
+        # mask: argmax * 255 | proba: softmax change probability stored as uint8 (x255) or float16
+        self.output_mode = getattr(args, 'output_mode', 'mask')
+        self.proba_dtype = {'uint8': torch.uint8, 'float16': torch.float16}[getattr(args, 'proba_dtype', 'uint8')]
+
         self.checkpoint_dir = args.checkpoint_dir
 
         self.pred_dir = args.output_folder
@@ -28,15 +40,13 @@ class CDEvaluator():
     def load_checkpoint(self, checkpoint_name='best_ckpt.pt'):
 
         if os.path.exists(os.path.join(self.checkpoint_dir, checkpoint_name)):
-            # load the entire checkpoint
-            checkpoint = torch.load(os.path.join(self.checkpoint_dir, checkpoint_name),
-                                    map_location=self.device, weights_only=False)
+            # the registry loads each checkpoint once per process
+            entry = model_registry.get_model(self.args, checkpoint_name)
 
-            self.net_G.load_state_dict(checkpoint['model_G_state_dict'])
-            self.net_G.to(self.device)
+            self.net_G = entry['net_G']
             # update some other states
-            self.best_val_acc = checkpoint['best_val_acc']
-            self.best_epoch_id = checkpoint['best_epoch_id']
+            self.best_val_acc = entry['best_val_acc']
+            self.best_epoch_id = entry['best_epoch_id']
 
         else:
             raise FileNotFoundError('no such checkpoint %s' % checkpoint_name)
@@ -48,13 +58,57 @@ class CDEvaluator():
         pred_vis = pred * 255
         return pred_vis
 
+    def _predict_proba(self):
+        """
+        Per-pixel change probability softmax(G_pred)[:, 1], (B,1,H,W).
+        uint8 maps [0, 1] to [0, 255], float16 keeps [0, 1].
+        """
+        proba = torch.softmax(self.G_pred, dim=1)[:, 1:2]
+        if self.proba_dtype == torch.uint8:
+            return (proba * 255).round().to(torch.uint8)
+        return proba.to(self.proba_dtype)
+
+    def _resolve_precision(self, precision):
+        assert precision in ('fp32', 'bf16', 'fp16'), 'unknown precision %s' % precision
+        if precision == 'fp16' and self.device.type != 'cuda':
+            print('⚠️  fp16 autocast needs CUDA, using bf16 on %s' % self.device.type)
+            precision = 'bf16'
+        return precision
+
+    def _autocast(self, precision):
+        if precision == 'fp32':
+            return contextlib.nullcontext()
+        dtype = torch.bfloat16 if precision == 'bf16' else torch.float16
+        return torch.autocast(device_type=self.device.type, dtype=dtype)
+
+    def _predict(self, img_in1, img_in2, precision):
+        if self.channels_last:
+            img_in1 = img_in1.contiguous(memory_format=torch.channels_last)
+            img_in2 = img_in2.contiguous(memory_format=torch.channels_last)
+        with self._autocast(precision):
+            if getattr(self.args, 'siamese_fusion', False):
+                # both dates share one encoder pass (ChangeFormerV6 only)
+                G_pred = self.net_G(img_in1, img_in2, siamese_fusion=True)[-1]
+            else:
+                G_pred = self.net_G(img_in1, img_in2)[-1]
+        return G_pred.float()
+
     def _forward_pass(self, batch):
         self.batch = batch
         img_in1 = batch['A'].to(self.device)
         img_in2 = batch['B'].to(self.device)
         self.shape_h = img_in1.shape[-2]
         self.shape_w = img_in1.shape[-1]
-        self.G_pred = self.net_G(img_in1, img_in2)[-1]
+        with torch.inference_mode():
+            self.G_pred = self._predict(img_in1, img_in2, self.precision)
+            self.precision_agreement = None
+            if self.verify_precision and self.precision != 'fp32':
+                # fraction of pixels per sample whose class matches the fp32 prediction
+                reference = torch.argmax(self._predict(img_in1, img_in2, 'fp32'), dim=1)
+                agree = torch.argmax(self.G_pred, dim=1) == reference
+                self.precision_agreement = agree.flatten(1).float().mean(dim=1)
+            if self.output_mode == 'proba':
+                return self._predict_proba()
         return self._visualize_pred()
 
     def eval(self):
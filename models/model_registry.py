@@ -0,0 +1,101 @@
+"""
+Process-wide registry of loaded change detection networks.
+
+Building ChangeFormerV6 and loading its checkpoint is the most expensive part of
+a request, so every network is loaded once per
+(net_G, checkpoint, device, dtype, attention backend, memory format) and shared by all callers afterwards.
+"""
+
+import os
+import threading
+
+import torch
+
+from models.networks import define_G
+from models.ChangeFormer import set_attention_backend, check_attention_parity
+
+
+# max abs difference of the change logits tolerated between an attention backend and eager
+ATTENTION_PARITY_TOLERANCE = 1e-3
+
+
+_models = {}
+_lock = threading.Lock()
+
+
+def get_device(gpu_ids):
+    return torch.device("cuda:%s" % gpu_ids[0]
+                        if torch.cuda.is_available() and len(gpu_ids) > 0
+                        else "cpu")
+
+
+def get_model(args, checkpoint_name='best_ckpt.pt', dtype=torch.float32):
+    """
+    Return the registry entry for args, loading the network on first use.
+
+    args.gpu_ids must already be a list of ints (see utils.get_device); the optional
+    args.attn_backend selects the encoder attention implementation (default 'eager')
+    and args.channels_last stores the conv weights in channels-last format.
+    The entry is a dict with 'net_G', 'best_val_acc', 'best_epoch_id' and the
+    'attn_backend' actually in use.
+    """
+    device = get_device(args.gpu_ids)
+    checkpoint_path = os.path.abspath(os.path.join(args.checkpoint_dir, checkpoint_name))
+    attn_backend = getattr(args, 'attn_backend', 'eager')
+    channels_last = getattr(args, 'channels_last', False)
+    key = (args.net_G, checkpoint_path, str(device), dtype, attn_backend, channels_last)
+
+    with _lock:
+        entry = _models.get(key)
+        if entry is None:
+            entry = _load(args, checkpoint_path, device, dtype, attn_backend, channels_last)
+            _models[key] = entry
+    return entry
+
+
+def _load(args, checkpoint_path, device, dtype, attn_backend, channels_last):
+    if not os.path.exists(checkpoint_path):
+        raise FileNotFoundError('no such checkpoint %s' % checkpoint_path)
+
+    print('Loading %s from %s on %s' % (args.net_G, checkpoint_path, device))
+    net_G = define_G(args=args, gpu_ids=args.gpu_ids)
+    checkpoint = torch.load(checkpoint_path, map_location=device, weights_only=False)
+    net_G.load_state_dict(checkpoint['model_G_state_dict'])
+    net_G.to(device=device, dtype=dtype)
+    if channels_last:
+        net_G.to(memory_format=torch.channels_last)
+    net_G.eval()
+
+    if attn_backend != 'eager':
+        try:
+            diff = check_attention_parity(net_G, attn_backend)
+        except RuntimeError as e:  # e.g. no SDPA kernel for this device / dtype
+            print('⚠️  %s attention is not usable here (%s)' % (attn_backend, e))
+            diff = float('inf')
+        if diff > ATTENTION_PARITY_TOLERANCE:
+            print('⚠️  %s attention differs from eager by %.2e, falling back to eager' % (attn_backend, diff))
+            set_attention_backend(net_G, 'eager')
+            attn_backend = 'eager'
+        else:
+            print('%s attention matches eager (max abs diff %.2e)' % (attn_backend, diff))
+
+    return {
+        'net_G': net_G,
+        'best_val_acc': checkpoint['best_val_acc'],
+        'best_epoch_id': checkpoint['best_epoch_id'],
+        'attn_backend': attn_backend,
+    }
+
+
+def loaded_models():
+    """Keys of every network currently held by the registry."""
+    with _lock:
+        return list(_models.keys())
+
+
+def clear():
+    """Drop all loaded networks (e.g. after a checkpoint was replaced on disk)."""
+    with _lock:
+        _models.clear()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
@@ -0,0 +1,90 @@
+"""
+Change overlays: the mask blended in color over the aligned A and B images.
+
+Both overlays are rendered in one pass over row strips with uint16 integer
+arithmetic (out = (image * (255 - alpha) + color * alpha) / 255, rounded), or as
+one torch expression per image when a CUDA device is configured.
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+
+OVERLAY_COLOR = (255, 0, 0)  # red, opacity given by the mask value
+
+
+def _alpha_for(mask, shape):
+    """The mask as per-pixel alpha for an image of shape, resized (nearest) if needed."""
+    if mask.shape[:2] != shape[:2]:
+        mask = cv2.resize(mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+    return mask
+
+
+def _div255(x):
+    """round(x / 255) for uint16 x <= 255 * 255, without an integer division."""
+    x += 128
+    x += x >> 8
+    x >>= 8
+    return x
+
+
+def _composite_cpu(images, mask, color, rows):
+    color = np.asarray(color, dtype=np.uint16)
+    outputs = []
+    for image in images:
+        out = np.empty(image.shape[:2] + (4,), dtype=np.uint8)
+        out[..., 3] = 255
+        outputs.append(out)
+
+    if all(image.shape[:2] == mask.shape[:2] for image in images):
+        # same alpha for every image: compute the strip's weights once
+        groups = [(images, outputs, mask)]
+    else:
+        groups = [([image], [out], _alpha_for(mask, image.shape)) for image, out in zip(images, outputs)]
+
+    for group_images, group_outputs, alpha in groups:
+        for top in range(0, alpha.shape[0], rows):
+            a = alpha[top:top + rows, :, None].astype(np.uint16)
+            inverse = 255 - a
+            tint = a * color
+            for image, out in zip(group_images, group_outputs):
+                blended = image[top:top + rows].astype(np.uint16)
+                blended *= inverse
+                blended += tint
+                out[top:top + rows, :, :3] = _div255(blended)
+    return outputs
+
+
+def _composite_torch(images, mask, color, device):
+    import torch
+
+    color = torch.tensor(color, dtype=torch.int32, device=device)
+    outputs = []
+    for image in images:
+        alpha = torch.from_numpy(np.ascontiguousarray(_alpha_for(mask, image.shape))).to(device)
+        alpha = alpha.to(torch.int32)[..., None]
+        blended = torch.from_numpy(np.ascontiguousarray(image)).to(device).to(torch.int32)
+        blended = (blended * (255 - alpha) + color * alpha + 127) // 255
+        out = torch.full(image.shape[:2] + (4,), 255, dtype=torch.uint8, device=device)
+        out[..., :3] = blended.to(torch.uint8)
+        outputs.append(out.cpu().numpy())
+    return outputs
+
+
+def composite_overlays(images, mask, color=OVERLAY_COLOR, rows=512, device=None):
+    """
+    RGBA uint8 overlays of mask (H, W) uint8 0-255 on every RGB uint8 image.
+
+    device: torch device to blend on; None uses CD_OVERLAY_DEVICE (default 'cpu').
+    rows: height of the strips blended at once on the CPU.
+    """
+    if device is None:
+        device = os.environ.get('CD_OVERLAY_DEVICE', 'cpu')
+    if str(device).startswith('cuda'):
+        import torch
+
+        if torch.cuda.is_available():
+            return _composite_torch(images, mask, color, device)
+    return _composite_cpu(images, mask, color, rows)
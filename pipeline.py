@@ -0,0 +1,157 @@
+"""
+Queue-connected processing stages running on their own threads.
+
+Every Stage has a pool of worker threads reading from a bounded input queue and
+writing to the next stage's queue, so e.g. alignment of pair i+1, inference of
+pair i and encoding of pair i-1 overlap. Each stage records how long its workers
+were busy, which Pipeline.stats() reports as a utilization. A Stage with batch > 1
+takes up to that many items at once, from those already waiting in its queue.
+"""
+
+import queue
+import threading
+import time
+
+
+_DONE = object()
+
+
+class _Failed:
+    """An item whose processing raised; passed through the remaining stages."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class Stage:
+    """
+    fn(item) -> item run by `workers` threads. With batch > 1, fn([items]) -> [items]
+    gets the next item plus those already queued behind it, up to batch items; it never
+    waits for more, so a slow upstream stage gives batches of 1 rather than a stall.
+    """
+
+    def __init__(self, name, fn, workers=1, batch=1):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch = batch
+        self.busy = 0.0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def _take(self, inbox):
+        """(entries, done): the next entries, up to batch of them; done once _DONE was taken."""
+        entry = inbox.get()
+        if entry is _DONE:
+            return [], True
+        entries = [entry]
+        while len(entries) < self.batch:
+            try:
+                entry = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if entry is _DONE:
+                return entries, True
+            entries.append(entry)
+        return entries, False
+
+    def _work(self, inbox, outbox, finished):
+        done = False
+        while not done:
+            entries, done = self._take(inbox)
+            live = [(index, item) for index, item in entries if not isinstance(item, _Failed)]
+            if live:
+                start = time.perf_counter()
+                items = [item for _, item in live]
+                try:
+                    items = self.fn(items) if self.batch > 1 else [self.fn(items[0])]
+                except Exception as e:
+                    items = [_Failed(e)] * len(live)
+                with self._lock:
+                    self.busy += time.perf_counter() - start
+                    self.items += len(live)
+                processed = dict(zip([index for index, _ in live], items))
+                entries = [(index, processed.get(index, item)) for index, item in entries]
+            for entry in entries:
+                outbox.put(entry)
+        finished()
+
+
+class Pipeline:
+    """
+    Runs items through stages in order. queue_depth bounds every inter-stage queue
+    (a batching stage's input queue holds at least its batch), which bounds the number
+    of items (and their images) in flight.
+    """
+
+    def __init__(self, stages, queue_depth=2):
+        self.stages = stages
+        self.queue_depth = queue_depth
+        self.wall = 0.0
+
+    def run(self, items):
+        """Process items; returns the outputs in input order. Re-raises the first failure."""
+        queues = [queue.Queue(maxsize=max(self.queue_depth, stage.batch)) for stage in self.stages]
+        results = queue.Queue()
+        outboxes = queues[1:] + [results]
+        threads = []
+        start = time.perf_counter()
+
+        for stage, inbox, outbox in zip(self.stages, queues, outboxes):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+
+            def finished(outbox=outbox, remaining=remaining, lock=lock, stage_index=len(threads)):
+                # the last worker of a stage closes the next queue for all of its workers
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    next_workers = (self.stages[stage_index + 1].workers
+                                    if stage_index + 1 < len(self.stages) else 1)
+                    for _ in range(next_workers):
+                        outbox.put(_DONE)
+
+            stage_threads = [threading.Thread(target=stage._work, args=(inbox, outbox, finished),
+                                              name='%s-%d' % (stage.name, i), daemon=True)
+                             for i in range(stage.workers)]
+            threads.append(stage_threads)
+            for thread in stage_threads:
+                thread.start()
+
+        def feed():
+            index = 0
+            try:
+                for index, item in enumerate(items):
+                    queues[0].put((index, item))
+            except Exception as e:  # e.g. a lazily decoded input failed
+                queues[0].put((index + 1, _Failed(e)))
+            finally:
+                for _ in range(self.stages[0].workers):
+                    queues[0].put(_DONE)
+
+        feeder = threading.Thread(target=feed, name='pipeline-feed', daemon=True)
+        feeder.start()
+
+        outputs = {}
+        while True:
+            entry = results.get()
+            if entry is _DONE:
+                break
+            outputs[entry[0]] = entry[1]
+        self.wall = time.perf_counter() - start
+
+        ordered = [outputs[index] for index in sorted(outputs)]
+        for item in ordered:
+            if isinstance(item, _Failed):
+                raise item.error
+        return ordered
+
+    def stats(self):
+        """Per stage: items, busy seconds and utilization of its workers over the last run."""
+        return {stage.name: {
+            'workers': stage.workers,
+            'items': stage.items,
+            'busy_s': round(stage.busy, 3),
+            'utilization': round(stage.busy / (self.wall * stage.workers), 3) if self.wall else 0.0,
+        } for stage in self.stages}
@@ -0,0 +1,140 @@
+"""
+Windowed access to large TIFF / BigTIFF rasters.
+
+RasterReader serves (left, upper, right, lower) windows without reading the whole
+scene: uncompressed contiguous files are memory-mapped, tiled or stripped files
+(compressed or not) only decode the segments that intersect the window.
+create_mask_memmap writes the output mask the same way, so a 30k x 30k scene is
+processed with memory bounded by the tile batch, not by the scene size.
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import tifffile
+
+
+class RasterReader:
+    """
+    Read windows of the first page of a TIFF / BigTIFF file as (h, w, C) arrays.
+
+    cache_segments: number of decoded segments kept around, so overlapping
+    windows do not decode the same TIFF tile twice.
+    """
+
+    def __init__(self, path, cache_segments=64):
+        self.path = path
+        self._tif = tifffile.TiffFile(path)
+        self._page = self._tif.pages[0]
+        page = self._page
+
+        self.height = page.imagelength
+        self.width = page.imagewidth
+        self.channels = page.samplesperpixel
+        self.dtype = page.dtype
+        self.shape = (self.height, self.width, self.channels)
+
+        self._separate = page.planarconfig == tifffile.PLANARCONFIG.SEPARATE
+        if page.is_tiled:
+            self._seg_h, self._seg_w = page.tilelength, page.tilewidth
+        else:
+            self._seg_h, self._seg_w = min(page.rowsperstrip, self.height), self.width
+        self._segs_down = -(-self.height // self._seg_h)
+        self._segs_across = -(-self.width // self._seg_w)
+
+        self._memmap = None
+        if page.is_memmappable:
+            self._memmap = self._normalize(tifffile.memmap(path, page=0, mode='r'))
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_segments = cache_segments
+
+    def close(self):
+        self._memmap = None
+        self._tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _normalize(self, arr):
+        """(H, W), (H, W, C) or planar (C, H, W) -> (H, W, C)."""
+        if arr.ndim == 2:
+            return arr[..., None]
+        if self._separate:
+            return arr.transpose(1, 2, 0)
+        return arr
+
+    def _segment(self, index):
+        """Decoded (seg_h, seg_w, samples) segment `index`, cropped to the image."""
+        with self._lock:
+            segment = self._cache.get(index)
+            if segment is not None:
+                self._cache.move_to_end(index)
+                return segment
+
+            page = self._page
+            offset, bytecount = page.dataoffsets[index], page.databytecounts[index]
+            fh = self._tif.filehandle
+            fh.seek(offset)
+            data = fh.read(bytecount)
+            decoded, (_, _, h, w, _), _ = page.decode(data, index, jpegtables=page.jpegtables)
+            if decoded is None:  # sparse file, missing segment
+                samples = 1 if self._separate else self.channels
+                decoded = np.zeros((1, self._seg_h, self._seg_w, samples), dtype=self.dtype)
+            segment = decoded[0, :self.height - h, :self.width - w]
+
+            self._cache[index] = segment
+            if len(self._cache) > self._cache_segments:
+                self._cache.popitem(last=False)
+            return segment
+
+    def read(self, box):
+        """Window (left, upper, right, lower), clipped to the image, as (h, w, C)."""
+        left, upper, right, lower = box
+        right, lower = min(right, self.width), min(lower, self.height)
+        if self._memmap is not None:
+            return np.array(self._memmap[upper:lower, left:right])
+
+        out = np.zeros((lower - upper, right - left, self.channels), dtype=self.dtype)
+        planes = self.channels if self._separate else 1
+        per_plane = self._segs_down * self._segs_across
+        for row in range(upper // self._seg_h, -(-lower // self._seg_h)):
+            for col in range(left // self._seg_w, -(-right // self._seg_w)):
+                y0, x0 = row * self._seg_h, col * self._seg_w
+                # intersection of the segment and the window, in image coordinates
+                ys, ye = max(y0, upper), min(y0 + self._seg_h, lower)
+                xs, xe = max(x0, left), min(x0 + self._seg_w, right)
+                for plane in range(planes):
+                    segment = self._segment(plane * per_plane + row * self._segs_across + col)
+                    part = segment[ys - y0:ye - y0, xs - x0:xe - x0]
+                    if self._separate:
+                        out[ys - upper:ye - upper, xs - left:xe - left, plane] = part[..., 0]
+                    else:
+                        out[ys - upper:ye - upper, xs - left:xe - left] = part
+        return out
+
+    def read_rgb(self, box):
+        """Window as RGB uint8: first three bands, grey replicated, wider dtypes rescaled."""
+        window = self.read(box)
+        if window.shape[2] >= 3:
+            window = window[..., :3]
+        else:
+            window = np.repeat(window[..., :1], 3, axis=2)
+        if window.dtype == np.uint8:
+            return np.ascontiguousarray(window)
+        if np.issubdtype(window.dtype, np.integer):
+            window = window.astype(np.float32) * (255.0 / np.iinfo(window.dtype).max)
+        else:
+            window = window.astype(np.float32) * 255.0  # float rasters are expected in [0, 1]
+        return np.clip(np.rint(window), 0, 255).astype(np.uint8)
+
+
+def create_mask_memmap(path, height, width):
+    """Create an (height, width) uint8 BigTIFF on disk and return it memory-mapped for writing."""
+    return tifffile.memmap(path, shape=(height, width), dtype=np.uint8,
+                           bigtiff=True, photometric='minisblack')
@@ -0,0 +1,77 @@
+"""
+Incremental writers for binary /change-detection responses.
+
+Each writer turns artifacts into body chunks as soon as they are produced, so a
+StreamingResponse can send an image's results while the next one is computed.
+"""
+
+import uuid
+import zipfile
+
+
+RESPONSE_FORMATS = ('json', 'multipart', 'zip', 'raw')
+
+
+class MultipartWriter:
+    """multipart/mixed body, one part per artifact."""
+
+    def __init__(self):
+        self.boundary = uuid.uuid4().hex
+        self.media_type = 'multipart/mixed; boundary=%s' % self.boundary
+
+    def write(self, name, data, content_type, headers=None):
+        lines = ['--%s' % self.boundary,
+                 'Content-Type: %s' % content_type,
+                 'Content-Disposition: attachment; filename="%s"' % name,
+                 'Content-Length: %d' % len(data)]
+        for key, value in (headers or {}).items():
+            lines.append('%s: %s' % (key, value))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8') + data + b'\r\n'
+
+    def close(self):
+        return ('--%s--\r\n' % self.boundary).encode('utf-8')
+
+
+class _ChunkBuffer:
+    """Write-only, unseekable file object collecting what zipfile writes."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipWriter:
+    """Streamed zip archive (stored, the PNGs are already compressed)."""
+
+    media_type = 'application/zip'
+
+    def __init__(self):
+        self._buffer = _ChunkBuffer()
+        self._zip = zipfile.ZipFile(self._buffer, 'w', compression=zipfile.ZIP_STORED)
+
+    def write(self, name, data, content_type=None, headers=None):
+        self._zip.writestr(name, data)
+        return self._buffer.drain()
+
+    def close(self):
+        self._zip.close()
+        return self._buffer.drain()
+
+
+def get_writer(response_format):
+    if response_format == 'zip':
+        return ZipWriter()
+    if response_format in ('multipart', 'raw'):
+        return MultipartWriter()
+    raise ValueError('no streaming writer for %s' % response_format)
@@ -0,0 +1,158 @@
+"""
+Content-addressed cache of change detection results.
+
+Entries are keyed by the hash of both uploaded images, the inference parameters
+and the checkpoint, so a re-submitted pair is answered without touching the
+model. Values (dicts of arrays and floats) live in an LRU memory tier bounded
+in bytes and optionally in a disk tier of .npz files evicted oldest-first.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+_checkpoint_hashes = {}
+_checkpoint_lock = threading.Lock()
+
+
+def checkpoint_hash(path):
+    """sha256 of a checkpoint file, computed once per (path, size, mtime)."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    with _checkpoint_lock:
+        digest = _checkpoint_hashes.get(memo_key)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            digest = _checkpoint_hashes[memo_key] = sha.hexdigest()
+    return digest
+
+
+def result_key(data_a, data_b, params, checkpoint):
+    """Hex digest identifying the result of one image pair under params and checkpoint."""
+    sha = hashlib.sha256()
+    for part in (hashlib.sha256(data_a).digest(), hashlib.sha256(data_b).digest(),
+                 json.dumps(params, sort_keys=True).encode('utf-8'), checkpoint.encode('utf-8')):
+        sha.update(part)
+    return sha.hexdigest()
+
+
+def _nbytes(value):
+    return sum(v.nbytes if isinstance(v, np.ndarray) else 8 for v in value.values())
+
+
+class ResultCache:
+    """
+    memory_bytes: budget of the in-memory LRU tier.
+    disk_dir / disk_bytes: optional on-disk tier and its size budget.
+    """
+
+    def __init__(self, memory_bytes=512 << 20, disk_dir=None, disk_bytes=2 << 30):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        self._counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters, memory_entries=len(self._memory), memory_bytes=self._memory_used)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / float(lookups) if lookups else 0.0
+        return stats
+
+    def get(self, key):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                return value
+
+        value = self._disk_get(key)
+        with self._lock:
+            self._counters['disk_hits' if value is not None else 'misses'] += 1
+        if value is not None:
+            self._memory_put(key, value)
+        return value
+
+    def put(self, key, value):
+        self._memory_put(key, value)
+        if self.disk_dir is not None:
+            self._disk_put(key, value)
+
+    def _memory_put(self, key, value):
+        size = _nbytes(value)
+        if size > self.memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_used -= _nbytes(self._memory.pop(key))
+            self._memory[key] = value
+            self._memory_used += size
+            while self._memory_used > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_used -= _nbytes(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key + '.npz')
+
+    def _disk_get(self, key):
+        if self.disk_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                value = {name: data[name].item() if data[name].ndim == 0 else data[name] for name in data.files}
+            os.utime(path)  # recently used files are evicted last
+        except (OSError, ValueError):
+            return None
+        return value
+
+    def _disk_put(self, key, value):
+        tmp_path = self._path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **{name: np.asarray(v) for name, v in value.items()})
+        os.replace(tmp_path, self._path(key))
+
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.disk_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        used = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if used <= self.disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except OSError:
+                pass
+            used -= size
+
+
+def cache_from_env():
+    """
+    ResultCache configured by CD_CACHE_MEMORY_MB (default 512, 0 disables the cache),
+    CD_CACHE_DIR (enables the disk tier) and CD_CACHE_DISK_MB (default 2048).
+    """
+    memory_mb = int(os.environ.get('CD_CACHE_MEMORY_MB', 512))
+    if memory_mb <= 0:
+        return None
+    return ResultCache(memory_bytes=memory_mb << 20,
+                       disk_dir=os.environ.get('CD_CACHE_DIR') or None,
+                       disk_bytes=int(os.environ.get('CD_CACHE_DISK_MB', 2048)) << 20)
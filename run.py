@@ -1,4 +1,8 @@
 import argparse
+import copy
+import tempfile
+from contextlib import nullcontext
+from io import BytesIO
 from PIL import Image
 import os
 import numpy as np
@@ -7,42 +11,58 @@ import cv2
 import utils
 import torch
 from models.basic_model import CDEvaluator
-from align import align_images
-
-def run_inference(data_dir, args, gpu_ids):
-    # Set up device
+from datasets.data_utils import CDDataAugmentation
+from align import get_aligner
+from tiler import Tiler
+from pipeline import Pipeline, Stage
+from fusion import binarize, fuse_masks, quantize, quantize_stack
+from overlay import composite_overlays
+from encoders import EXTENSIONS, Encoder
+from raster_io import RasterReader, create_mask_memmap
+
+def build_args(project_name='ChangeFormer_DSIFN', checkpoint_name='best_ckpt.pt', gpu_ids='0',
+               output_folder='predicted', data_dir=None, siamese_fusion=True, attn_backend='sdpa',
+               precision='fp32', channels_last=False, verify_precision=False,
+               output_mode='mask', proba_dtype='uint8'):
+    class Args:
+        pass
+    args = Args()
+    args.data_dir = data_dir
+    args.output_folder = output_folder
+    args.project_name = project_name
+    args.checkpoint_name = checkpoint_name
     args.gpu_ids = gpu_ids
-    utils.get_device(args)
-    device = torch.device("cuda:%s" % args.gpu_ids[0]
-                          if torch.cuda.is_available() and len(args.gpu_ids)>0
-                        else "cpu")
+    args.checkpoint_root = 'checkpoints/'
     args.checkpoint_dir = os.path.join(args.checkpoint_root, args.project_name)
-    os.makedirs(args.output_folder, exist_ok=True)
-
-    # Set dataset to ImageDataset for custom data_dir
+    args.num_workers = 12
     args.dataset = 'ImageDataset'
-
-    data_loader = utils.get_loader(args.data_name, img_size=args.img_size,
-                                   batch_size=args.batch_size,
-                                   split=args.split, is_train=False,
-                                   dataset=args.dataset, root_dir=data_dir)
-
-    model = CDEvaluator(args)
+    args.data_name = 'quick_start_DSIFN'
+    args.batch_size = 1
+    args.split = "demo"
+    args.n_class = 2
+    args.embed_dim = 256
+    args.net_G = 'ChangeFormerV6'
+    # run pre and post images through the shared encoder as one batch
+    args.siamese_fusion = siamese_fusion
+    # eager | sdpa | mem_efficient, checked against eager when the model is loaded
+    args.attn_backend = attn_backend
+    # fp32 | bf16 | fp16 autocast; verify_precision also runs fp32 to measure mask agreement
+    args.precision = precision
+    args.channels_last = channels_last
+    args.verify_precision = verify_precision
+    # mask: argmax masks | proba: softmax change probabilities kept as uint8 or float16
+    args.output_mode = output_mode
+    args.proba_dtype = proba_dtype
+    return args
+
+def load_model(args):
+    """Return a CDEvaluator bound to the shared network for args (see models.model_registry)."""
+    model_args = copy.copy(args)
+    utils.get_device(model_args)
+    model = CDEvaluator(model_args)
     model.load_checkpoint(args.checkpoint_name)
     model.eval()
-
-    masks = {}
-    for i, batch in enumerate(data_loader):
-        name = batch['name']
-        if isinstance(name, list):
-            name = name[0]
-        print('process: %s' % name)
-        score_map = model._forward_pass(batch)
-        # Assuming score_map is (1,1,H,W), squeeze to (H,W)
-        mask = score_map.squeeze().cpu().numpy().astype(np.float32)
-        masks[name] = mask
-
-    return masks
+    return model
 
 def main():
     parser = argparse.ArgumentParser(description='Crop images in data_dir into n x n square pieces and run change detection.')
@@ -68,31 +88,38 @@ def main():
     parser.add_argument('--net_G', default='ChangeFormerV6', type=str,
                         help='ChangeFormerV6 | CD_SiamUnet_diff | SiamUnet_conc | Unet | DTCDSCN | base_resnet18 | base_transformer_pos_s4_dd8 | base_transformer_pos_s4_dd8_dedim8|')
     parser.add_argument('--checkpoint_name', default='best_ckpt.pt', type=str)
-    
+    parser.add_argument('--queue_depth', default=2, type=int, help='Pairs buffered between align / infer / fuse / save stages')
+    parser.add_argument('--mask_codec', default='png', choices=['png', 'png1', 'raw'], help='png: 8-bit grey PNG; png1: 1-bit / palette PNG; raw: uint8 bytes')
+    parser.add_argument('--image_codec', default='png', choices=['png', 'webp', 'jpeg', 'raw'], help='Codec of the color mask and overlays')
+    parser.add_argument('--png_level', default=6, type=int, help='zlib compression level of PNG outputs (0-9)')
+    parser.add_argument('--quality', default=80, type=int, help='Quality of WebP / JPEG outputs (0-100)')
+    parser.add_argument('--outputs', default=','.join(OUTPUTS), type=str, help='Comma separated artifacts to write: ' + ', '.join(OUTPUTS))
+
+    # Streaming mode for large co-registered TIFF / BigTIFF scenes
+    parser.add_argument('--raster_a', default=None, type=str, help='TIFF of the first date (enables streaming mode)')
+    parser.add_argument('--raster_b', default=None, type=str, help='TIFF of the second date')
+    parser.add_argument('--raster_out', default='change_mask.tif', type=str, help='BigTIFF mask written in streaming mode')
+    parser.add_argument('--tile_overlap', default=None, type=float, help='Fraction of the tile size shared by neighbouring tiles (default 0.25 in streaming mode, 0 for the crops of calls > 1)')
+
     args = parser.parse_args()
 
-    run_change_detection(args.data_dir, args.calls_nb, args.img_size, args.crop_image, args.output_folder, args.project_name, args.checkpoint_name, args.gpu_ids)
+    if args.raster_a is not None:
+        run_change_detection_raster(args.raster_a, args.raster_b, args.raster_out, img_size=args.img_size,
+                                    tile_overlap=0.25 if args.tile_overlap is None else args.tile_overlap,
+                                    project_name=args.project_name,
+                                    checkpoint_name=args.checkpoint_name, gpu_ids=args.gpu_ids,
+                                    batch_size=args.batch_size)
+        return
 
-def run_change_detection(data_dir, calls_nb=1, img_size=512, crop_image=False, output_folder='predicted', project_name='ChangeFormer_DSIFN', checkpoint_name='best_ckpt.pt', gpu_ids='0', n=2):
-    # Set up args
-    class Args:
-        pass
-    args = Args()
-    args.data_dir = data_dir
-    args.output_folder = output_folder
-    args.project_name = project_name
-    args.checkpoint_name = checkpoint_name
-    args.gpu_ids = gpu_ids
-    args.checkpoint_root = 'checkpoints/'
-    args.num_workers = 12
-    args.dataset = 'ImageDataset'
-    args.data_name = 'quick_start_DSIFN'
-    args.batch_size = 1
-    args.split = "demo"
-    args.n_class = 2
-    args.embed_dim = 256
-    args.net_G = 'ChangeFormerV6'
+    run_change_detection(args.data_dir, args.calls_nb, args.img_size, args.crop_image, args.output_folder, args.project_name, args.checkpoint_name, args.gpu_ids, batch_size=args.batch_size, queue_depth=args.queue_depth,
+                         tile_overlap=args.tile_overlap or 0.0,
+                         encoder=Encoder(args.mask_codec, args.image_codec, args.png_level, args.quality),
+                         outputs=parse_outputs(args.outputs))
+
+OUTPUTS = ('mask', 'color_mask', 'overlay_a', 'overlay_b')
+OUTPUT_SUFFIXES = {'mask': '', 'color_mask': '_color', 'overlay_a': '_A_overlay', 'overlay_b': '_B_overlay'}
 
+def run_change_detection(data_dir, calls_nb=1, img_size=512, crop_image=False, output_folder='predicted', project_name='ChangeFormer_DSIFN', checkpoint_name='best_ckpt.pt', gpu_ids='0', n=2, aligner=None, batch_size=4, siamese_fusion=True, attn_backend='sdpa', precision='fp32', channels_last=False, verify_precision=False, output_mode='mask', proba_dtype='uint8', fusion='vote', tile_overlap=0.0, blend='cosine', queue_depth=2, encoder=None, outputs=OUTPUTS):
     # Read the list
     list_path = os.path.join(data_dir, 'list', 'demo.txt')
     if not os.path.exists(list_path):
@@ -102,252 +129,411 @@ def run_change_detection(data_dir, calls_nb=1, img_size=512, crop_image=False, o
     with open(list_path, 'r') as f:
         image_names = [line.strip() for line in f if line.strip()]
 
-    # Align images
-    aligned_data_dir = f"{data_dir}_aligned"
-    a_dir = os.path.join(aligned_data_dir, 'A')
-    b_dir = os.path.join(aligned_data_dir, 'B')
-    list_dir = os.path.join(aligned_data_dir, 'list')
-    os.makedirs(a_dir, exist_ok=True)
-    os.makedirs(b_dir, exist_ok=True)
-    os.makedirs(list_dir, exist_ok=True)
-
+    # Images are decoded in the align stage, at most queue_depth pairs ahead of the GPU
+    pairs = []
     for image_name in image_names:
         img_a_path = os.path.join(data_dir, 'A', image_name)
         img_b_path = os.path.join(data_dir, 'B', image_name)
         if os.path.exists(img_a_path) and os.path.exists(img_b_path):
-            print(f"Aligning {image_name}")
-            img_a_aligned, img_b_aligned = align_images(img_a_path, img_b_path)
-            # Convert BGR to RGB for PIL
-            img_a_rgb = cv2.cvtColor(img_a_aligned, cv2.COLOR_BGR2RGB)
-            img_b_rgb = cv2.cvtColor(img_b_aligned, cv2.COLOR_BGR2RGB)
-            img_a_pil = Image.fromarray(img_a_rgb)
-            img_b_pil = Image.fromarray(img_b_rgb)
-            img_a_pil.save(os.path.join(a_dir, image_name))
-            img_b_pil.save(os.path.join(b_dir, image_name))
-
-    # Copy the list
-    with open(os.path.join(list_dir, 'demo.txt'), 'w') as f:
-        for name in image_names:
-            f.write(name + '\n')
-
-    # Use aligned data
-    data_dir = aligned_data_dir
-
-    # Get original sizes from aligned
-    original_sizes = {}
-    for image_name in image_names:
-        img_path = os.path.join(data_dir, 'A', image_name)
-        if os.path.exists(img_path):
-            with Image.open(img_path) as img:
-                original_sizes[image_name] = img.size[::-1]  # (h, w)
+            pairs.append((image_name, img_a_path, img_b_path))
 
     os.makedirs(output_folder, exist_ok=True)
 
-    all_masks = {}  # name -> list of masks
-
+    if encoder is None:
+        encoder = Encoder()
+
+    def save(name, result):
+        base = os.path.splitext(name)[0]
+        for key, data, _, _ in encoder.encode_all(result, outputs):
+            path = os.path.join(output_folder, f"{base}{OUTPUT_SUFFIXES[key]}.{EXTENSIONS[encoder.codec(key)]}")
+            with open(path, 'wb') as f:
+                f.write(data)
+            print(f"Saved {key}: {path}")
+
+    # Results are saved as they are encoded; only names (and agreements) are kept
+    results, _ = run_change_detection_pipelined(pairs, calls_nb=calls_nb, img_size=img_size,
+                                                crop_image=crop_image, project_name=project_name,
+                                                checkpoint_name=checkpoint_name, gpu_ids=gpu_ids, aligner=aligner,
+                                                batch_size=batch_size, siamese_fusion=siamese_fusion,
+                                                attn_backend=attn_backend, precision=precision,
+                                                channels_last=channels_last, verify_precision=verify_precision,
+                                                output_mode=output_mode, proba_dtype=proba_dtype, fusion=fusion,
+                                                tile_overlap=tile_overlap, blend=blend, outputs=outputs, encode=save,
+                                                queue_depth=queue_depth)
+    return results
+
+def run_change_detection_arrays(images_a, images_b, names=None, calls_nb=1, img_size=512, crop_image=False, project_name='ChangeFormer_DSIFN', checkpoint_name='best_ckpt.pt', gpu_ids='0', n=2, aligner=None, batch_size=4, siamese_fusion=True, attn_backend='sdpa', precision='fp32', channels_last=False, verify_precision=False, output_mode='mask', proba_dtype='uint8', fusion='vote', tile_overlap=0.0, blend='cosine', outputs=OUTPUTS, keep_call_masks=False, progress=None, batcher=None, gate=None):
+    """
+    In-memory variant of run_change_detection: nothing is written to or read from disk.
+
+    images_a, images_b: lists of RGB uint8 arrays (H, W, 3), paired by index.
+    names: optional list of names used as result keys (defaults to '0', '1', ...).
+    batch_size: number of same-size tiles stacked into one forward pass.
+    siamese_fusion: encode A and B tiles in a single batched encoder pass (same result, fewer launches).
+    attn_backend: encoder attention implementation, 'eager', 'sdpa' or 'mem_efficient'.
+    precision: 'fp32', or 'bf16' / 'fp16' autocast; channels_last: channels-last tensors and weights.
+    verify_precision: with a reduced precision, also run fp32 and report the mask agreement.
+    output_mode: 'mask' fuses argmax masks, 'proba' fuses softmax change probabilities
+    (held as proba_dtype, 'uint8' or 'float16', until fusion).
+    fusion: 'vote' counts per-scale detections (0 / 128 / 255); 'mean' averages the
+    probabilities across scales into a 0-255 confidence mask (needs output_mode='proba').
+    tile_overlap: fraction of the tile size shared by neighbouring crops of calls > 1;
+    blend: 'cosine', 'linear' or 'none' weighting of the overlaps (see tiler.Tiler).
+    progress: optional callback progress(stage, name, call) with stage 'aligned',
+    'inferred' (all tiles of that call are done) or 'fused' (call is None except for 'inferred').
+    batcher: optional micro_batching.MicroBatcher shared with concurrent callers.
+    gate: optional semaphore held around every forward pass run without the batcher.
+    outputs: artifacts to render besides the mask, any of OUTPUTS; the others are skipped.
+    keep_call_masks: also return 'call_masks', the (calls, H, W) uint8 per-call masks
+    that render_outputs needs to add the color mask later.
+
+    Returns {name: {'mask', 'color_mask', 'overlay_a', 'overlay_b'}} (the latter three if
+    requested in outputs) where mask is an (H, W) uint8 array, color_mask is (H, W, 3) RGB and the overlays are (H, W, 4) RGBA.
+    With verify_precision each result also has 'precision_agreement', the mean fraction of
+    model-resolution pixels whose class matches the fp32 prediction.
+    """
+    if names is None:
+        names = [str(i) for i in range(len(images_a))]
+    if not (len(names) == len(images_a) == len(images_b)):
+        raise ValueError('images_a, images_b and names must have the same length')
+    check_options(output_mode, fusion, tile_overlap)
+
+    args = build_args(project_name, checkpoint_name, gpu_ids, siamese_fusion=siamese_fusion,
+                      attn_backend=attn_backend, precision=precision, channels_last=channels_last,
+                      verify_precision=verify_precision, output_mode=output_mode, proba_dtype=proba_dtype)
+    model = load_model(args)
+
+    # Align images (the extractor and matcher are shared across pairs)
+    if aligner is None:
+        aligner = get_aligner()
+    # Pairs sharing the same A image (one "before" against a time series) extract it once
+    print(f"Aligning {len(names)} pairs")
+    aligned = dict(zip(names, aligner.align_pairs(images_a, images_b, batch_size)))
+    if progress is not None:
+        for name in names:
+            progress('aligned', name, None)
+
+    # Plan every tile of every call first so that tiles sharing an input size
+    # (across images and scales) can be stacked into the same forward pass
+    tiles, tilers = [], {}
     for call in range(1, calls_nb + 1):
-        current_img_size = img_size // (2 ** (call - 1))
-        args.img_size = current_img_size
-        print(f"Call {call}: img_size = {current_img_size}")
+        print(f"Call {call}: img_size = {img_size // (2 ** (call - 1))}")
+    for name, (img_a, img_b) in aligned.items():
+        plan_tiles(name, img_a, img_b, calls_nb, img_size, crop_image, tile_overlap, blend, tiles, tilers)
 
-        if call == 1 or not crop_image:
-            # Run on full images
-            masks = run_inference(data_dir, args, gpu_ids)
-            for name, mask in masks.items():
-                if name in original_sizes:
-                    h, w = original_sizes[name]
-                    mask = cv2.resize(mask, (w, h), interpolation=cv2.INTER_LINEAR)
-                if name not in all_masks:
-                    all_masks[name] = []
-                all_masks[name].append(mask)
-        else:
-            # Crop into pieces where each piece size equals current_img_size
-            cropped_data_dir = f"{data_dir}_cropped_{call}"
-            a_dir = os.path.join(cropped_data_dir, 'A')
-            b_dir = os.path.join(cropped_data_dir, 'B')
-            list_dir = os.path.join(cropped_data_dir, 'list')
-            os.makedirs(a_dir, exist_ok=True)
-            os.makedirs(b_dir, exist_ok=True)
-            os.makedirs(list_dir, exist_ok=True)
-
-            crop_names = []
-            original_sizes = {}
-            for image_name in image_names:
-                img_before_path = os.path.join(data_dir, 'A', image_name)
-                img_after_path = os.path.join(data_dir, 'B', image_name)
-
-                if not os.path.exists(img_before_path) or not os.path.exists(img_after_path):
-                    continue
-
-                img_before = Image.open(img_before_path)
-                img_after = Image.open(img_after_path)
-                width, height = img_before.size
-
-                if width != height:
-                    continue
-
-                # Calculate number of crops per side based on current_img_size
-                # Each piece should be current_img_size
-                crops_per_side = width // current_img_size
-                if crops_per_side < 1:
-                    crops_per_side = 1
-                crop_size = current_img_size
-                
-                base_name = os.path.splitext(image_name)[0]
-                original_sizes[image_name] = (height, width)  # (h, w)
-
-                for j in range(crops_per_side):
-                    for i in range(crops_per_side):
-                        left = i * crop_size
-                        upper = j * crop_size
-                        right = min(left + crop_size, width)
-                        lower = min(upper + crop_size, height)
-
-                        crop_before = img_before.crop((left, upper, right, lower))
-                        crop_after = img_after.crop((left, upper, right, lower))
-
-                        crop_name = f"{base_name}_{j*crops_per_side + i + 1}.png"
-                        crop_names.append(crop_name)
-
-                        crop_before.save(os.path.join(a_dir, crop_name))
-                        crop_after.save(os.path.join(b_dir, crop_name))
-
-            # Create list/demo.txt
-            with open(os.path.join(list_dir, 'demo.txt'), 'w') as f:
-                for name in crop_names:
-                    f.write(name + '\n')
-
-            # Run inference on cropped
-            masks = run_inference(cropped_data_dir, args, gpu_ids)
-
-            # Combine crops back
-            combined_masks = {}
-            for original in image_names:
-                if original not in original_sizes:
-                    continue
-                base = os.path.splitext(original)[0]
-                full_h, full_w = original_sizes[original]
-                
-                # Calculate number of crops per side based on current_img_size
-                crops_per_side = full_w // current_img_size
-                if crops_per_side < 1:
-                    crops_per_side = 1
-                crop_size = current_img_size
-                total_crops = crops_per_side * crops_per_side
-                
-                crop_bases = [f"{base}_{k+1}" for k in range(total_crops)]
-                crop_masks = []
-                for cb in crop_bases:
-                    crop_name = cb + '.png'
-                    if crop_name in masks:
-                        mask = masks[crop_name]
-                        mask = cv2.resize(mask, (crop_size, crop_size), interpolation=cv2.INTER_LINEAR)
-                        crop_masks.append(mask)
-                
-                if len(crop_masks) == total_crops:
-                    full_mask = np.zeros((full_h, full_w), dtype=np.float32)
-                    for idx, mask in enumerate(crop_masks):
-                        i = idx // crops_per_side
-                        j = idx % crops_per_side
-                        start_h = i * crop_size
-                        start_w = j * crop_size
-                        end_h = min((i + 1) * crop_size, full_h)
-                        end_w = min((j + 1) * crop_size, full_w)
-                        full_mask[start_h:end_h, start_w:end_w] = mask[:end_h-start_h, :end_w-start_w]
-                    combined_masks[original] = full_mask
-
-            for name, mask in combined_masks.items():
-                if name not in all_masks:
-                    all_masks[name] = []
-                all_masks[name].append(mask)
+    tile_masks, tile_agreements = infer_tiles(model, tiles, batch_size, batcher=batcher, progress=progress,
+                                              gate=gate)
+    call_masks = assemble_call_masks(tiles, tile_masks, tilers,
+                                     {name: pair[0].shape[:2] for name, pair in aligned.items()}, output_mode)
 
     # Combine masks with detection levels
-    for name in all_masks:
-        masks_list = all_masks[name]
+    results = {}
+    for name in aligned:
+        masks_list = [call_masks[(name, call)] for call in range(1, calls_nb + 1) if (name, call) in call_masks]
         if masks_list:
-            h, w = masks_list[0].shape
-            # Count detections per pixel
-            detection_count = np.zeros((h, w), dtype=int)
-            for mask in masks_list:
-                detection_count += (mask > 0.5).astype(int)
-            
-            # Assign levels: 0=black, 1=50% white, 2=100% white
-            bw_mask = np.zeros((h, w), dtype=np.uint8)
-            bw_mask[detection_count == 1] = 128  # 50% white
-            bw_mask[detection_count >= 2] = 255  # 100% white
-            
-            mask_img = Image.fromarray(bw_mask, 'L')
-            mask_path = os.path.join(output_folder, f"{os.path.splitext(name)[0]}.png")
-            mask_img.save(mask_path)
-            print(f"Saved BW mask: {mask_path}")
-
-            # Also save color mask
-            colors = [(0, 255, 0), (0, 0, 255)]  # green for call 1, blue for call 2
-            color_mask = np.zeros((h, w, 3), dtype=np.float32)
-            for i, mask in enumerate(masks_list):
-                color = np.array(colors[i % len(colors)], dtype=np.float32) / 255.0
-                for c in range(3):
-                    color_mask[..., c] += mask * color[c]
-            color_mask = np.clip(color_mask, 0, 1)
-            color_mask_uint8 = (color_mask * 255).astype(np.uint8)
-            color_mask_img = Image.fromarray(color_mask_uint8, 'RGB')
-            color_mask_path = os.path.join(output_folder, f"{os.path.splitext(name)[0]}_color.png")
-            color_mask_img.save(color_mask_path)
-            print(f"Saved color mask: {color_mask_path}")
-
-    # Create overlays
-    create_overlays(data_dir, output_folder, image_names)
-
-def create_overlays(data_dir, output_folder, image_names):
-    for image_name in image_names:
-        base = os.path.splitext(image_name)[0]
-        mask_path = os.path.join(output_folder, f"{base}.png")
-        
-        if not os.path.exists(mask_path):
-            print(f"Warning: Mask {mask_path} not found, skipping overlay")
+            agreements = [a for tile, a in zip(tiles, tile_agreements) if tile[0] == name and a is not None]
+            results[name] = fuse_result(name, aligned[name], masks_list, output_mode, fusion, agreements, precision,
+                                        outputs, keep_call_masks)
+            if progress is not None:
+                progress('fused', name, None)
+
+    return results
+
+def run_change_detection_pipelined(pairs, calls_nb=1, img_size=512, crop_image=False, project_name='ChangeFormer_DSIFN', checkpoint_name='best_ckpt.pt', gpu_ids='0', aligner=None, batch_size=4, siamese_fusion=True, attn_backend='sdpa', precision='fp32', channels_last=False, verify_precision=False, output_mode='mask', proba_dtype='uint8', fusion='vote', tile_overlap=0.0, blend='cosine', outputs=OUTPUTS, encode=None, queue_depth=2, align_workers=1, fuse_workers=2, encode_workers=2, batcher=None):
+    """
+    Staged variant of run_change_detection_arrays for a stream of pairs.
+
+    pairs: iterable of (name, a, b) where a / b are RGB uint8 arrays, encoded image bytes
+    or file paths; they are decoded in the align stage, so the iterable can be lazy.
+    Stages decode + align -> infer (all calls of one pair, on the GPU) -> fuse + overlays
+    -> encode are connected by queues of queue_depth items and run on their own threads,
+    so the alignment of pair i+1, the inference of pair i and the encoding of pair i-1
+    overlap. The infer stage takes the aligned pairs already waiting, up to batch_size,
+    and stacks their same-size tiles into shared forward passes. encode(name, result), if given, runs in the last stage (e.g. saving PNGs);
+    the arrays of a pair are then dropped once encoded, so memory stays bounded by
+    queue_depth whatever the number of pairs.
+
+    Returns (results, stats): results as run_change_detection_arrays (without encode) or
+    {name: {}} holding only 'precision_agreement' if any (with encode), stats the
+    per-stage utilization from pipeline.Pipeline.stats().
+    """
+    check_options(output_mode, fusion, tile_overlap)
+    args = build_args(project_name, checkpoint_name, gpu_ids, siamese_fusion=siamese_fusion,
+                      attn_backend=attn_backend, precision=precision, channels_last=channels_last,
+                      verify_precision=verify_precision, output_mode=output_mode, proba_dtype=proba_dtype)
+    model = load_model(args)
+    if aligner is None:
+        aligner = get_aligner()
+
+    def align_stage(item):
+        name, a, b = item
+        print(f"Aligning {name}")
+        return name, aligner.align_arrays(load_rgb(a), load_rgb(b))
+
+    def infer_stage(items):
+        # Tiles are keyed by position in the batch, so repeated names do not collide
+        tiles, tilers = [], {}
+        for i, (_, (img_a, img_b)) in enumerate(items):
+            plan_tiles(i, img_a, img_b, calls_nb, img_size, crop_image, tile_overlap, blend, tiles, tilers)
+        tile_masks, tile_agreements = infer_tiles(model, tiles, batch_size, batcher=batcher)
+        call_masks = assemble_call_masks(tiles, tile_masks, tilers,
+                                         {i: pair[0].shape[:2] for i, (_, pair) in enumerate(items)}, output_mode)
+        inferred = []
+        for i, (name, pair) in enumerate(items):
+            masks_list = [call_masks[(i, call)] for call in range(1, calls_nb + 1) if (i, call) in call_masks]
+            agreements = [a for tile, a in zip(tiles, tile_agreements) if tile[0] == i and a is not None]
+            inferred.append((name, pair, masks_list, agreements))
+        return inferred
+
+    def fuse_stage(item):
+        name, pair, masks_list, agreements = item
+        return name, fuse_result(name, pair, masks_list, output_mode, fusion, agreements, precision, outputs)
+
+    def encode_stage(item):
+        name, result = item
+        encode(name, result)
+        return name, {key: value for key, value in result.items() if not isinstance(value, np.ndarray)}
+
+    stages = [Stage('align', align_stage, align_workers), Stage('infer', infer_stage, 1, batch=batch_size),
+              Stage('fuse', fuse_stage, fuse_workers)]
+    if encode is not None:
+        stages.append(Stage('encode', encode_stage, encode_workers))
+    pipeline = Pipeline(stages, queue_depth=queue_depth)
+    results = dict(pipeline.run(pairs))
+
+    stats = pipeline.stats()
+    for stage_name, stage_stats in stats.items():
+        print(f"{stage_name}: {stage_stats['items']} items, {stage_stats['busy_s']:.2f}s busy, "
+              f"{stage_stats['utilization'] * 100:.0f}% utilization")
+    return results, stats
+
+def parse_outputs(outputs):
+    """Tuple of artifact names from a comma separated string; raises ValueError for unknown ones."""
+    names = tuple(name.strip() for name in outputs.split(',') if name.strip())
+    unknown = [name for name in names if name not in OUTPUTS]
+    if unknown:
+        raise ValueError('unknown outputs %s, expected any of %s' % (', '.join(unknown), ', '.join(OUTPUTS)))
+    return names
+
+def check_options(output_mode, fusion, tile_overlap):
+    if fusion not in ('vote', 'mean'):
+        raise ValueError('fusion must be vote or mean')
+    if fusion == 'mean' and output_mode != 'proba':
+        raise ValueError("fusion='mean' needs output_mode='proba'")
+    if not 0 <= tile_overlap < 1:
+        raise ValueError('tile_overlap must be in [0, 1)')
+
+def load_rgb(source):
+    """RGB uint8 array from an array, encoded image bytes or a file path."""
+    if isinstance(source, np.ndarray):
+        return source
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    return np.asarray(Image.open(source).convert('RGB'))
+
+def plan_tiles(name, img_a, img_b, calls_nb, img_size, crop_image, tile_overlap, blend, tiles, tilers):
+    """
+    Append the tiles of every call of one aligned pair to tiles as
+    (name, call, box or None for the full image, img_a tile, img_b tile, input size);
+    tilers[(name, call)] gets the Tiler blending the cropped tiles back together.
+    """
+    for call in range(1, calls_nb + 1):
+        current_img_size = img_size // (2 ** (call - 1))
+        if call == 1 or not crop_image:
+            # Run on full images
+            tiles.append((name, call, None, img_a, img_b, current_img_size))
             continue
-        
-        # Load images
-        a_path = os.path.join(data_dir, 'A', image_name)
-        b_path = os.path.join(data_dir, 'B', image_name)
-        
-        if not os.path.exists(a_path) or not os.path.exists(b_path):
-            print(f"Warning: A or B image not found for {image_name}, skipping overlay")
+
+        # Overlapping current_img_size windows covering the whole (possibly
+        # rectangular) image; the last row / column is shifted back inside it
+        height, width = img_a.shape[:2]
+        tiler = Tiler(height, width, current_img_size,
+                      overlap=int(tile_overlap * current_img_size), blend=blend)
+        tilers[(name, call)] = tiler
+        for box, (tile_a, tile_b) in tiler.tiles(img_a, img_b):
+            tiles.append((name, call, box, tile_a, tile_b, current_img_size))
+
+def infer_tiles(model, tiles, batch_size, batcher=None, progress=None, gate=None):
+    """Run every planned tile, same input sizes stacked together; returns (masks, agreements) per tile."""
+    tile_masks = [None] * len(tiles)
+    tile_agreements = [None] * len(tiles)
+    for size in sorted({tile[5] for tile in tiles}, reverse=True):
+        indices = [k for k, tile in enumerate(tiles) if tile[5] == size]
+        agreements = []
+        masks = run_inference_arrays(model, [(tiles[k][3], tiles[k][4]) for k in indices], size, batch_size,
+                                     agreements=agreements, batcher=batcher, gate=gate)
+        for k, mask in zip(indices, masks):
+            tile_masks[k] = mask
+        for k, agreement in zip(indices, agreements):
+            tile_agreements[k] = agreement
+        if progress is not None:
+            for name, call in sorted({tiles[k][:2] for k in indices}, key=lambda key: key[1]):
+                progress('inferred', name, call)
+    return tile_masks, tile_agreements
+
+def assemble_call_masks(tiles, tile_masks, tilers, shapes, output_mode='mask'):
+    """
+    Combine tiles back into one full size uint8 map per (name, call): 0 / 255 detections
+    in 'mask' mode, 0-255 probability levels in 'proba' mode. Crops are blended.
+
+    Every tile map is turned into uint8 and its tile_masks entry cleared as soon as it is
+    read, and each Tiler is merged and removed from tilers after the last tile of its
+    call, so a single float accumulator is alive at a time. A resized full image
+    counts its interpolated edges as detected (the > 0.5 rule); a blended crop map is
+    cut at the 0-255 midpoint, so a seam pixel is detected when most of the overlapping
+    tiles detect it.
+    """
+    last = {tile[:2]: k for k, tile in enumerate(tiles)}  # tiles of a call are contiguous
+    call_masks = {}
+    for k, (name, call, box, _, _, size) in enumerate(tiles):
+        mask, tile_masks[k] = tile_masks[k], None
+        if output_mode == 'proba':
+            mask = quantize(mask)
+        else:
+            mask = (mask > 127).astype(np.uint8) * 255  # argmax * 255
+        if box is None:
+            height, width = shapes[name]
+            mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_LINEAR)
+            if output_mode != 'proba':
+                mask[mask > 0] = 255
+            call_masks[(name, call)] = mask
             continue
-        
-        img_a = Image.open(a_path).convert('RGB')
-        img_b = Image.open(b_path).convert('RGB')
-        mask_img = Image.open(mask_path).convert('L')
-        mask_array = np.array(mask_img).astype(np.float32) / 255.0  # 0-1
-        
-        # Create overlays
-        overlay_a = create_overlay(img_a, mask_array)
-        overlay_b = create_overlay(img_b, mask_array)
-        
-        # Save overlays
-        overlay_a_path = os.path.join(output_folder, f"{base}_A_overlay.png")
-        overlay_b_path = os.path.join(output_folder, f"{base}_B_overlay.png")
-        overlay_a.save(overlay_a_path)
-        overlay_b.save(overlay_b_path)
-        print(f"Created overlays: {overlay_a_path}, {overlay_b_path}")
-
-def create_overlay(image, mask_array):
-    # mask_array is np.array (H,W) 0-1
-    # Resize mask to match image size if necessary
-    if mask_array.shape[:2] != image.size[::-1]:
-        mask_pil = Image.fromarray((mask_array * 255).astype(np.uint8), 'L')
-        mask_pil = mask_pil.resize(image.size, Image.NEAREST)
-        mask_array = np.array(mask_pil).astype(np.float32) / 255.0
-    
-    # Convert mask to RGBA for overlay
-    mask_rgba_array = np.zeros((image.size[1], image.size[0], 4), dtype=np.uint8)
-    mask_rgba_array[..., :3] = [255, 0, 0]  # Red
-    mask_rgba_array[..., 3] = (mask_array * 255).astype(np.uint8)  # Alpha based on mask value
-    
-    mask_overlay = Image.fromarray(mask_rgba_array, 'RGBA')
-    
-    # Composite overlay on image
-    return Image.alpha_composite(image.convert('RGBA'), mask_overlay)
+        key = (name, call)
+        tilers[key].add(cv2.resize(mask, (size, size), interpolation=cv2.INTER_LINEAR), box)
+        if k == last[key]:
+            call_masks[key] = tilers.pop(key).merge()
+            if output_mode != 'proba':
+                binarize(call_masks[key])
+    return call_masks
+
+def fuse_result(name, pair, masks_list, output_mode, fusion, agreements=None, precision='fp32', outputs=OUTPUTS, keep_call_masks=False):
+    """Fuse the per-call masks of one image and render the requested color mask and overlays."""
+    bw_mask, color_mask_uint8 = fuse_masks(masks_list, output_mode, fusion, color='color_mask' in outputs)
+
+    result = {'mask': bw_mask}
+    if color_mask_uint8 is not None:
+        result['color_mask'] = color_mask_uint8
+    if keep_call_masks:
+        result['call_masks'] = quantize_stack(masks_list, output_mode)
+    render_outputs(result, outputs, pair)
+    if agreements:
+        result['precision_agreement'] = float(np.mean(agreements))
+        print(f"{name}: {precision} mask agreement with fp32 = {result['precision_agreement']:.4f}")
+    return result
+
+def run_change_detection_raster(path_a, path_b, output_path, img_size=1024, tile_overlap=0.25, blend='cosine', project_name='ChangeFormer_DSIFN', checkpoint_name='best_ckpt.pt', gpu_ids='0', batch_size=4, siamese_fusion=True, attn_backend='sdpa', precision='fp32', channels_last=False, output_mode='mask', proba_dtype='uint8'):
+    """
+    Streaming change detection on two co-registered TIFF / BigTIFF scenes of the same size.
+
+    Windows of img_size pixels (overlapping by tile_overlap) are read from both rasters,
+    run batch_size at a time at native resolution and blended into a memory-mapped
+    accumulator; the uint8 mask (0/255, or the 0-255 change probability with
+    output_mode='proba') is written to the BigTIFF output_path. Only the current batch
+    and the TIFF segments it touches are held in memory. No alignment is done.
+    """
+    if not 0 <= tile_overlap < 1:
+        raise ValueError('tile_overlap must be in [0, 1)')
+
+    args = build_args(project_name, checkpoint_name, gpu_ids, siamese_fusion=siamese_fusion,
+                      attn_backend=attn_backend, precision=precision, channels_last=channels_last,
+                      output_mode=output_mode, proba_dtype=proba_dtype)
+    model = load_model(args)
+
+    with RasterReader(path_a) as reader_a, RasterReader(path_b) as reader_b, \
+            tempfile.TemporaryDirectory() as workdir:
+        if (reader_a.height, reader_a.width) != (reader_b.height, reader_b.width):
+            raise ValueError('rasters differ in size: %s vs %s' % (reader_a.shape, reader_b.shape))
+        height, width = reader_a.height, reader_a.width
+        tiler = Tiler(height, width, img_size, overlap=int(tile_overlap * img_size), blend=blend,
+                      workdir=workdir)
+        print(f"{path_a}: {width}x{height}, {len(tiler)} tiles of {img_size}")
+
+        def flush(batch):
+            masks = run_inference_arrays(model, [(a, b) for _, a, b in batch], img_size, len(batch))
+            for (box, _, _), mask in zip(batch, masks):
+                if mask.dtype == np.float16:
+                    mask = mask.astype(np.float32) * 255  # [0, 1] probability to the uint8 output scale
+                tiler.add(mask.astype(np.float32), box)
+
+        batch = []
+        full_tile = (0, 0, img_size, img_size)
+        for done, box in enumerate(tiler.boxes, 1):
+            batch.append((box, tiler.crop(reader_a.read_rgb(box), full_tile),
+                          tiler.crop(reader_b.read_rgb(box), full_tile)))
+            if len(batch) == batch_size:
+                flush(batch)
+                batch = []
+                print(f"{done}/{len(tiler)} tiles")
+        if batch:
+            flush(batch)
+
+        out = create_mask_memmap(output_path, height, width)
+        tiler.merge(out=out)
+        if output_mode != 'proba':
+            # blended seams hold averages of 0 and 255, keep the mask binary
+            for top in range(0, height, 1024):
+                binarize(out[top:top + 1024])
+        out.flush()
+        del out
+
+    return output_path
+
+def run_inference_arrays(model, pairs, img_size, batch_size=1, agreements=None, batcher=None, gate=None):
+    """
+    Run model on [(img_a, img_b)] RGB uint8 pairs resized to img_size, batch_size pairs per
+    forward pass; returns one (img_size, img_size) mask per pair (float32 argmax * 255, or the
+    uint8 / float16 change probability when the model's output_mode is 'proba').
+    If agreements is a list and the model verifies its precision, the per-pair fp32
+    agreement is appended to it.
+    With a micro_batching.MicroBatcher the pairs may share forward passes with other callers;
+    otherwise gate (e.g. a semaphore) is held around each forward pass.
+    """
+    if batcher is not None:
+        # one batch_size chunk is preprocessed and queued at a time, as without a batcher
+        results = []
+        for start in range(0, len(pairs), batch_size):
+            results.extend(batcher.infer(model, [preprocess_pair(img_a, img_b, img_size)
+                                                 for img_a, img_b in pairs[start:start + batch_size]],
+                                         img_size, batch_size))
+        if agreements is not None:
+            agreements.extend(agree for _, agree in results if agree is not None)
+        return [mask for mask, _ in results]
+
+    masks = []
+    for start in range(0, len(pairs), batch_size):
+        batch = [preprocess_pair(img_a, img_b, img_size) for img_a, img_b in pairs[start:start + batch_size]]
+        with gate or nullcontext():
+            score_map = model._forward_pass({'A': torch.stack([a for a, _ in batch]),
+                                             'B': torch.stack([b for _, b in batch])})
+            # score_map is (B,1,H,W), one (H,W) mask per pair
+            score_map = score_map[:, 0].cpu().numpy()
+            agreement = model.precision_agreement
+            if agreement is not None:
+                agreement = agreement.cpu().tolist()
+        if model.output_mode != 'proba':
+            score_map = score_map.astype(np.float32)
+        masks.extend(score_map)
+        if agreements is not None and agreement is not None:
+            agreements.extend(agreement)
+    return masks
+
+def preprocess_pair(img_a, img_b, img_size):
+    """Resize and normalise a pair exactly like ImageDataset does for inference."""
+    [tensor_a, tensor_b], _ = CDDataAugmentation(img_size=img_size).transform([img_a, img_b], [], to_tensor=True)
+    return tensor_a, tensor_b
+
+def render_outputs(result, outputs, pair=None, output_mode='mask'):
+    """
+    Add the requested artifacts missing from result, in place: the color mask from its
+    'call_masks', the overlays from its mask and the aligned (img_a, img_b) pair.
+    """
+    if 'color_mask' in outputs and 'color_mask' not in result:
+        _, result['color_mask'] = fuse_masks(list(result['call_masks']), output_mode)
+    keys = [key for key in ('overlay_a', 'overlay_b') if key in outputs and key not in result]
+    if keys:
+        images = [pair[0] if key == 'overlay_a' else pair[1] for key in keys]
+        result.update(zip(keys, composite_overlays(images, result['mask'])))
+    return result
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
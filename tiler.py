@@ -0,0 +1,143 @@
+"""
+Sliding-window tiling of arbitrary rectangles with blended reassembly.
+
+A Tiler cuts an (H, W) image into tile_size x tile_size windows that overlap by
+`overlap` pixels. The last row / column of windows is shifted back inside the
+image so no remainder pixels are dropped, and images smaller than a tile are
+padded. Model outputs for every window are accumulated with a blending weight
+and normalised, so seams between tiles are averaged instead of cut.
+"""
+
+import os
+
+import numpy as np
+
+
+BLEND_MODES = ('cosine', 'linear', 'none')
+
+
+def window_starts(length, tile_size, step):
+    """Start offsets of windows covering [0, length), the last one flush with the end."""
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size + 1, step))
+    if starts[-1] + tile_size < length:
+        starts.append(length - tile_size)
+    return starts
+
+
+def blend_weights(tile_size, overlap, blend='cosine'):
+    """
+    (tile_size, tile_size) float32 weights, 1 in the middle and ramping down over
+    the `overlap` border pixels. Weights stay > 0 so every pixel is normalisable.
+    """
+    if blend not in BLEND_MODES:
+        raise ValueError('blend must be one of %s' % (BLEND_MODES,))
+    ramp = np.ones(tile_size, dtype=np.float32)
+    overlap = min(overlap, tile_size // 2)
+    if blend != 'none' and overlap > 0:
+        t = np.arange(1, overlap + 1, dtype=np.float32) / (overlap + 1)
+        if blend == 'cosine':
+            t = 0.5 - 0.5 * np.cos(np.pi * t)
+        ramp[:overlap] = t
+        ramp[-overlap:] = t[::-1]
+    return np.outer(ramp, ramp)
+
+
+class Tiler:
+    """
+    Tiles an (height, width) image into overlapping tile_size windows.
+
+    overlap: pixels shared by neighbouring windows (< tile_size).
+    blend: 'cosine', 'linear' or 'none' (plain average) weighting of overlaps.
+    pad_mode: np.pad mode used when the image is smaller than a tile.
+    workdir: if set, the blending accumulators are memory-mapped files in this
+    directory instead of RAM (for scenes that do not fit in memory).
+    """
+
+    def __init__(self, height, width, tile_size, overlap=0, blend='cosine', pad_mode='reflect', workdir=None):
+        if not 0 <= overlap < tile_size:
+            raise ValueError('overlap must be in [0, tile_size)')
+        self.height = height
+        self.width = width
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.pad_mode = pad_mode
+        self.workdir = workdir
+        self.weights = blend_weights(tile_size, overlap, blend)
+
+        step = tile_size - overlap
+        self.boxes = [(left, upper, left + tile_size, upper + tile_size)
+                      for upper in window_starts(height, tile_size, step)
+                      for left in window_starts(width, tile_size, step)]
+
+        self._acc = None
+        self._weight_sum = None
+        self._dtype = None
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def crop(self, image, box):
+        """The box of image as a full tile_size tile, padded past the image border."""
+        left, upper, right, lower = box
+        tile = image[upper:lower, left:right]
+        pad_h = self.tile_size - tile.shape[0]
+        pad_w = self.tile_size - tile.shape[1]
+        if pad_h or pad_w:
+            pad = [(0, pad_h), (0, pad_w)] + [(0, 0)] * (tile.ndim - 2)
+            mode = self.pad_mode
+            if mode == 'reflect' and (pad_h >= tile.shape[0] or pad_w >= tile.shape[1]):
+                mode = 'symmetric'  # reflect cannot pad more than the tile itself
+            tile = np.pad(tile, pad, mode=mode)
+        return tile
+
+    def tiles(self, *images):
+        """Yield (box, [tile of each image]) for every window."""
+        for box in self.boxes:
+            yield box, [self.crop(image, box) for image in images]
+
+    def add(self, tile_map, box):
+        """Accumulate a (tile_size, tile_size[, C]) model output for box."""
+        if self._acc is None:
+            self._dtype = tile_map.dtype
+            self._acc = self._zeros('acc', (self.height, self.width) + tile_map.shape[2:])
+            self._weight_sum = self._zeros('weight_sum', (self.height, self.width))
+        left, upper, right, lower = box
+        h = min(lower, self.height) - upper
+        w = min(right, self.width) - left
+        weights = self.weights[:h, :w]
+        values = tile_map[:h, :w].astype(np.float32)
+        if values.ndim == 3:
+            values *= weights[..., None]
+        else:
+            values *= weights
+        self._acc[upper:upper + h, left:left + w] += values
+        self._weight_sum[upper:upper + h, left:left + w] += weights
+
+    def _zeros(self, name, shape):
+        if self.workdir is None:
+            return np.zeros(shape, dtype=np.float32)
+        return np.lib.format.open_memmap(os.path.join(self.workdir, name + '.npy'), mode='w+',
+                                         dtype=np.float32, shape=shape)
+
+    def merge(self, out=None, rows=1024):
+        """
+        Blended full-size map in the dtype of the added tiles, or written into `out`
+        (e.g. a memory-mapped output) `rows` rows at a time and in out's dtype.
+        """
+        if self._acc is None:
+            raise ValueError('no tile was added')
+        if out is None:
+            out = np.empty(self._acc.shape, dtype=self._dtype)
+        for upper in range(0, self.height, rows):
+            lower = min(upper + rows, self.height)
+            weight_sum = np.maximum(self._weight_sum[upper:lower], 1e-6)
+            if self._acc.ndim == 3:
+                weight_sum = weight_sum[..., None]
+            merged = self._acc[upper:lower] / weight_sum
+            if np.issubdtype(out.dtype, np.integer):
+                info = np.iinfo(out.dtype)
+                merged = np.clip(np.rint(merged), info.min, info.max)
+            out[upper:lower] = merged
+        return out